@@ -1,11 +1,13 @@
 import logging
 
-from flask import Flask, render_template, session, request, abort, Blueprint, redirect
+from flask import Flask, render_template, session, request, abort, Blueprint, redirect, jsonify
 
 from pg_shared import prepare_app
 from pg_shared.dash_utils import add_dash_to_routes
 from AggViewFlask.dash_apps import dash_basic
-from agg_view import AT_NAME, core, Langstrings, menu
+from agg_view import AT_NAME, core, Langstrings, menu, local_time_zones, facet_top_n, series_cache
+from agg_series import series_response
+from agg_metrics import metrics
 
 at_root = core.at_root
 
@@ -26,6 +28,16 @@ def index():
 def ping():
     return "OK"
 
+@pt_bp.route("/metrics")
+def metrics_view():
+    # per-stage counters for this process: calls, seconds, rows read, records written and Cosmos RUs (see agg_metrics.py)
+    return jsonify(metrics.snapshot())
+
+@pt_bp.route("/series", methods=['GET'])
+def series():
+    # range query API, see agg_series.series_response()
+    return series_response(series_cache, local_time_zones, facet_top_n)
+
 @pt_bp.route("/about", methods=['GET'])
 def about():
     view_name = "about"
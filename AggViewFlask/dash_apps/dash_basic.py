@@ -1,23 +1,23 @@
 # import logging
 
 from pg_shared.dash_utils import create_dash_app_util, date_range_control, compute_range
-from agg_view import core, menu, Langstrings
+from agg_view import core, range_query, distinct_values, local_time_zones, facet_top_n, menu, Langstrings
+from agg_charts import series_figure
+from agg_metrics import timed
 from flask import session
 from datetime import datetime as dt, timedelta
 
 from dash import html, dcc, callback_context, no_update
-import plotly.express as px
 from dash.dependencies import Output, Input, State
 
-import pandas as pd
-
 view_name = "basic"  # this is required
 
 agg_fields = ("tag", "plaything_name", "plaything_part", "specification_id")
 
-plaything_names = list(core.aggregated_container.query_items("SELECT DISTINCT VALUE c.plaything_name FROM c", enable_cross_partition_query=True))
-if "-" in plaything_names:
-    plaything_names.remove("-")
+def plaything_names():
+    # read when the page loads (from a TTL cache), rather than at import, so it does not add to cold start or go stale
+    return [pn for pn in distinct_values("plaything_name") if pn != "-"]
+
 
 def create_dash(server, url_rule, url_base_pathname):
     """Create a Dash view"""
@@ -43,13 +43,16 @@ def create_dash(server, url_rule, url_base_pathname):
                 html.Div(
                     [
                         html.Label("(Plaything Name:)", id="plaything_name_label", style={"margin-top": "0px"}),
-                        dcc.Dropdown(id="plaything_name", options=plaything_names, searchable=False, clearable=True, style={"margin-left": "10px"}),
+                        dcc.Dropdown(id="plaything_name", options=[], searchable=False, clearable=True, style={"margin-left": "10px"}),
                         html.Label("(Show Facets:)", id="facet_label", style={"margin-top": "10px"}),
                         dcc.Dropdown(value=None, options=agg_fields, id="facet_options", searchable=False, clearable=True, style={"margin-left": "10px"}),
                         html.Label("(Filter by:)", id="filter_by_label", style={"margin-top": "10px"}),
                         dcc.Dropdown(value=None, options=agg_fields, id="filter_by_options", searchable=False, clearable=True, style={"margin-left": "10px"}),
                         # html.Label("=", id="filter_value_label", style={"margin-top": "10px"}),
-                        dcc.Dropdown(value=None, id="filter_value_options", searchable=False, clearable=True, style={"margin-left": "10px"})
+                        dcc.Dropdown(value=None, id="filter_value_options", searchable=False, clearable=True, style={"margin-left": "10px"}),
+                        # dates are UTC unless a time zone with local day records is chosen
+                        html.Label("(Time zone:)", id="tz_label", style={"margin-top": "10px"}),
+                        dcc.Dropdown(value="UTC", options=["UTC"] + local_time_zones, id="tz", searchable=False, clearable=False, style={"margin-left": "10px"})
                     ], className="col-sm-4"
                 ),
                 
@@ -82,13 +85,16 @@ def create_dash(server, url_rule, url_base_pathname):
             Output("plaything_name_label", "children"),
             Output("facet_label", "children"),
             Output("filter_by_label", "children"),
-            Output("date_range_div", "children")
+            Output("tz_label", "children"),
+            Output("date_range_div", "children"),
+            Output("plaything_name", "options")
         ],
         [
             Input("location", "pathname"),
             Input("location", "search")
             ]
     )
+    @timed("view.initial_load")
     def initial_load(pathname, querystring):
         lang = "en"
         if len(querystring) > 0:
@@ -110,6 +116,7 @@ def create_dash(server, url_rule, url_base_pathname):
                 langstrings.get("PLAYTHING_NAME"),
                 langstrings.get("SHOW_FACET"),
                 langstrings.get("FILTER_BY"),
+                langstrings.get("TIME_ZONE"),
                 [   
                     date_range_control(start_date_, end_date_),
                     html.Div(
@@ -118,10 +125,11 @@ def create_dash(server, url_rule, url_base_pathname):
                             dcc.RadioItems(options={"count": "Count", "sessions": "Sessions"}, value="count", id="metric", inline=True, inputStyle={"margin-left": "20px"})
                         ], className="mt-2"
                     )
-                ]
+                ],
+                plaything_names()
             ]
         else:
-            output = [no_update] * 6
+            output = [no_update] * 8
 
         return output
 
@@ -134,6 +142,7 @@ def create_dash(server, url_rule, url_base_pathname):
          Input("range-lastmonth", "n_clicks"), Input("range-thismonth", "n_clicks"),  Input("minus-month", "n_clicks"), Input("plus-month", "n_clicks")],
         [State("date-start", "date"), State("date-end", "date")]
     )
+    @timed("view.set_range")
     def set_range(rt_clicks, ry_clicks, dm_clicks, dp_clicks,
                   r7d_clicks, wm_clicks, wp_clicks,
                   rlm_clicks, rcm_clicks, mm_clicks, mp_clicks,
@@ -160,10 +169,12 @@ def create_dash(server, url_rule, url_base_pathname):
             Input("filter_value_options", "value"),
             Input("date-start", "date"),
             Input("date-end", "date"),
-            Input("metric", "value")
+            Input("metric", "value"),
+            Input("tz", "value")
         ]
     )
-    def update_charts(plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric):
+    @timed("view.update_charts")
+    def update_charts(plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric, tz):
         tid = callback_context.triggered_id
 
         # effects on drop-down lists. first set up default outputs (default values are as Inputs)
@@ -195,49 +206,16 @@ def create_dash(server, url_rule, url_base_pathname):
             if filter_by_option is None:
                 new_filter_value_options = []
             else:
-                qry = f"SELECT DISTINCT VALUE c.{filter_by_option} FROM c"
-                if plaything_name is not None:
-                    qry += f" WHERE c.plaything_name = '{plaything_name}'"
-                new_filter_value_options = list(core.aggregated_container.query_items(qry, enable_cross_partition_query=True))
+                new_filter_value_options = distinct_values(filter_by_option, plaything_name)
 
         # if the filter-by has changed but the value not yet specified, DO NOT update the fiture, otherwise DO
         if (tid == "filter_by_options") and (filter_value_option is None):
             figure = no_update
         else:
-            # chart prep
-            start_dt = dt.strptime(start_date, "%Y-%m-%d")
-            end_dt = dt.strptime(end_date, "%Y-%m-%d")
-            start_ts = int(start_dt.timestamp())  # ts for DB query
-            end_ts = int(end_dt.timestamp()) + 24 * 3600 # the dt at the **start** of the end date in the range
-            # query data. for ranges of 5 days or less, query the date_hr set, otherwise query the date set
-            is_date_hr = (end_dt - start_dt).days < 5
-            period_name = "date_hr" if is_date_hr else "date"
-            select_parts = [
-                f"c.{period_name}",
-                f"c.{metric}"
-            ]
-            if facet_option is not None:
-                select_parts.append(f"c.{facet_option}")
-            where_parts = [
-                "IS_DEFINED(c.date_hr)" if is_date_hr else "IS_DEFINED(c.date)",
-                f"c.start_ts >= {start_ts}",
-                f"c.start_ts < {end_ts}"
-            ]
-            if plaything_name is not None:
-                where_parts.append(f"c.plaything_name = '{plaything_name}'")
-            if (filter_by_option is not None) and (filter_value_option is not None):
-                where_parts.append(f"c.{filter_by_option} = '{filter_value_option}'")
-            qry = f"SELECT {', '.join(select_parts)} FROM c WHERE {' AND '.join(where_parts)}"
-            # print(qry)
-            
-            raw_df = pd.DataFrame(core.aggregated_container.query_items(qry, enable_cross_partition_query=True))
-            if facet_option is None:
-                # un-segmented bars, summed over each date or date_hr slot
-                prep_df = raw_df.groupby(period_name)[metric].sum().reset_index()
-                figure = px.bar(prep_df, x=period_name, y=metric)
-            else:
-                prep_df = raw_df.groupby([period_name, facet_option])[metric].sum().reset_index()
-                figure = px.bar(prep_df, x=period_name, y=metric, color=facet_option)
+            # the same memoised path as the range query API, so viewers share results
+            _, series = range_query(plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric,
+                                    None if tz == "UTC" else tz, top_n=facet_top_n)
+            figure = series_figure(series)
         
         return [new_facet_options, facet_option, new_filter_by_options, filter_by_option, new_filter_value_options, filter_value_option, figure]
 
@@ -0,0 +1,107 @@
+from datetime import datetime as dt, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import plotly.graph_objects as go
+
+from agg_time import period_bounds, local_day_start, ts_of_date_hr
+from session_sketch import STANDARD_ERROR
+
+# Chart building for the Basic view, kept apart from the Dash app so that it can be used (and benchmarked) with any AggCube.
+# range_series() computes the grouped data, which is also served by the range query API (see agg_view.range_query()), and
+# series_figure() draws it.
+# Facets with many values (e.g. specification_id) are collapsed to the top_n values over the range plus "other", and the figure is built
+# from a periods x facet values array with one go.Bar trace per value, so the figure's size is bounded by top_n and the number of
+# periods, whatever the cardinality of the facet. The collapsed values have a null facet value in the series, so that they cannot be
+# confused with a facet value which happens to be "other", and are shown as other_label.
+
+# The chart uses the coarsest tier which gives at least min_bars periods over the date range, so the amount of data stays roughly
+# constant however long the range is. Week and month bars cover the whole period, even where the range only covers part of it.
+# With a time zone, the dates are local dates and the local day tier is used for anything coarser than hours (there are no local weeks or
+# months), while hours are labelled with their local time.
+min_bars = 5
+tier_days = (("month", 30.44), ("week", 7), ("date", 1))
+other_label = "other"  # legend name for the facet values collapsed by top_n
+
+
+def choose_period(start_dt, end_dt):
+    days = (end_dt - start_dt).days
+    for period_name, period_days in tier_days:
+        if days / period_days >= min_bars:
+            return period_name
+    return "date_hr"
+
+
+def range_series(cube, plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric, tz=None, top_n=None):
+    # The grouped data for a chart (or the range query API): a dict with the period tier used, the timestamp range, a DataFrame of the
+    # metric by period (and facet value) and, for sessions, the distinct sessions over the whole range. tz is None for UTC, or one of
+    # the "local_time_zones" which the aggregator makes local day records for. top_n limits the facet values (see AggCube.series()).
+    start_dt = dt.strptime(start_date, "%Y-%m-%d")
+    end_dt = dt.strptime(end_date, "%Y-%m-%d")
+    # query data. for ranges of 5 days or less, query the date_hr set, otherwise the coarsest tier giving enough bars
+    period_name = choose_period(start_dt, end_dt)
+    if tz is None:
+        start_ts = int(start_dt.timestamp())  # ts for DB query
+        end_ts = int(end_dt.timestamp()) + 24 * 3600 # the dt at the **start** of the end date in the range
+        if period_name in ("week", "month"):
+            start_ts = period_bounds(period_name, start_ts)[1]  # include the period containing the start date
+    else:
+        zone = ZoneInfo(tz)
+        start_ts = local_day_start(zone, start_dt.date())
+        end_ts = local_day_start(zone, end_dt.date() + timedelta(days=1))
+        if period_name != "date_hr":
+            period_name = "local_date"
+    equals = {}
+    if plaything_name is not None:
+        equals["plaything_name"] = plaything_name
+    if (filter_by_option is not None) and (filter_value_option is not None):
+        equals[filter_by_option] = filter_value_option
+
+    # grouped from the in-memory cube. For sessions, sketches are merged; summing would over-count sessions spanning records
+    cube_tz = tz if period_name == "local_date" else None
+    series = {"period": period_name, "start_ts": start_ts, "end_ts": end_ts, "facet": facet_option, "metric": metric, "tz": tz,
+              "df": cube.series(period_name, start_ts, end_ts, metric, facet=facet_option, equals=equals, tz=cube_tz, top_n=top_n)}
+    if tz is not None and period_name == "date_hr":
+        # local time labels, with the zone abbreviation to tell apart the repeated hour when daylight saving time ends
+        series["df"][period_name] = [dt.fromtimestamp(ts_of_date_hr(dh), tz=zone).strftime("%Y-%m-%dT%H %Z") for dh in series["df"][period_name]]
+    if metric == "sessions":
+        series["range_sessions"] = cube.range_sessions(period_name, start_ts, end_ts, equals=equals, tz=cube_tz)
+    return series
+
+
+def pivot(df, period_name, facet_option, metric):
+    # periods (sorted), facet values (by descending total, with other last) and a facet values x periods array of the metric
+    periods, period_ix = np.unique(df[period_name].to_numpy(dtype=str), return_inverse=True)
+    if facet_option is None:
+        values = np.zeros((1, len(periods)), dtype=np.int64)
+        np.add.at(values[0], period_ix, df[metric].to_numpy(dtype=np.int64))
+        return periods, [None], values
+    is_other = df[facet_option].isna().to_numpy()
+    facets, facet_ix = np.unique(df[facet_option].to_numpy(dtype=object)[~is_other].astype(str), return_inverse=True)
+    rows = np.full(len(df), len(facets), dtype=np.int64)  # the other row is after the facet values
+    rows[~is_other] = facet_ix
+    values = np.zeros((len(facets) + 1, len(periods)), dtype=np.int64)
+    np.add.at(values, (rows, period_ix), df[metric].to_numpy(dtype=np.int64))
+    order = sorted(range(len(facets)), key=lambda i: -values[i].sum())
+    names = [str(facets[i]) for i in order]
+    if is_other.any():
+        order.append(len(facets))
+        names.append(other_label)
+    return periods, names, values[order]
+
+
+def series_figure(series):
+    period_name, facet_option, metric = series["period"], series["facet"], series["metric"]
+    periods, facets, values = pivot(series["df"], period_name, facet_option, metric)
+    # un-segmented bars, summed over each date or date_hr slot, or one trace per facet value, stacked
+    figure = go.Figure([go.Bar(x=periods.tolist(), y=row, name=facet) for facet, row in zip(facets, values)])
+    figure.update_layout(barmode="relative", xaxis_title=period_name, yaxis_title=metric, legend_title_text=facet_option,
+                         showlegend=facet_option is not None)
+    if metric == "sessions":
+        figure.update_layout(title=f"Distinct sessions in range: {series['range_sessions']} (estimated, standard error {STANDARD_ERROR:.1%})")
+    return figure
+
+
+def counts_figure(cube, plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric, tz=None, top_n=None):
+    return series_figure(range_series(cube, plaything_name, facet_option, filter_by_option, filter_value_option, start_date, end_date, metric,
+                                      tz=tz, top_n=top_n))
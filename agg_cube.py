@@ -0,0 +1,254 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from agg_metrics import stage
+from agg_store import DELETED_ID
+from session_sketch import M, registers_of, grouped_distinct_sessions
+
+# An in-process, columnar copy of the agg container, so that the dashboard can answer facet/filter/date-range questions from memory
+# rather than with one cross-partition query per click. The aggregate data is small and only changes hourly.
+# - key fields and the period value are categorical-encoded (int32 codes into a list of values)
+# - count, sessions and start_ts are int64 arrays
+# - session sketches are decoded once, as they are read, into a (256, n) uint8 array with a column of registers for each record (256 bytes
+#   per record), so that the "sessions" metric merges each group's sketches with np.maximum.reduceat rather than decoding strings per query
+# The cube is loaded lazily on first use and then, at most every "ttl" seconds, refreshed incrementally by reading the documents
+# modified since the last refresh (which is nothing, most of the time, and one hour's records after the aggregator has run).
+# Replaced records (e.g. from re-aggregation) are updated in place by id. Deleted records are not seen by reading modified documents, so the
+# aggregator logs their ids in the DELETED_ID document (see aggregator.delete_records()), which is itself re-read when it changes, and their
+# rows are dropped. If the log has dropped deletions which the cube has not applied yet, the cube is reloaded from scratch.
+# Refreshes build new arrays and swap them in, so a query in another thread always sees a consistent snapshot.
+# Local day ("local_date") records are kept with their time zone, so queries of that tier are for one zone ("tz").
+
+key_fields = ("tag", "plaything_name", "plaything_part", "specification_id")
+period_fields = ("date_hr", "date", "week", "month", "local_date")
+
+
+class Categories:
+    # grow-only value <-> int code mapping
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+
+class _Columns:
+    __slots__ = ("keys", "period_field", "period", "tz", "count", "sessions", "start_ts", "registers", "has_sketch")
+
+    def __init__(self, n=0):
+        self.keys = {f: np.zeros(n, dtype=np.int32) for f in key_fields}
+        self.period_field = np.zeros(n, dtype=np.int8)
+        self.period = np.zeros(n, dtype=np.int32)
+        self.tz = np.zeros(n, dtype=np.int16)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.sessions = np.zeros(n, dtype=np.int64)
+        self.start_ts = np.zeros(n, dtype=np.int64)
+        self.registers = np.zeros((M, n), dtype=np.uint8)
+        self.has_sketch = np.zeros(n, dtype=bool)  # False for records aggregated before sketches were stored
+
+    def take(self, rows):
+        cols = _Columns()
+        cols.keys = {f: a[rows] for f, a in self.keys.items()}
+        for name in ("period_field", "period", "tz", "count", "sessions", "start_ts", "has_sketch"):
+            setattr(cols, name, getattr(self, name)[rows])
+        cols.registers = np.take(self.registers, rows, axis=1)
+        return cols
+
+
+class AggCube:
+    def __init__(self, agg_store, ttl=300):
+        self.agg_store = agg_store
+        self.ttl = ttl
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.categories = {f: Categories() for f in key_fields}
+        self.periods = Categories()
+        self.zones = Categories()
+        self.zones.code(None)  # code 0, for records which are not local days
+        self.row_ix = {}  # record id -> row
+        self.max_modified = 0
+        self.deleted_seq = 0  # the last deletion applied from the DELETED_ID document
+        self._cols = _Columns()
+        self._ranks = {}
+
+    def _decode(self, cats):
+        # values of a Categories as an array, and the sort position of each code; cached until more values are added
+        cached = self._ranks.get(id(cats))
+        if cached is None or len(cached[0]) != len(cats.values):
+            values = np.array(cats.values, dtype=object)
+            cached = self._ranks[id(cats)] = (values, np.argsort(np.argsort(values)))
+        return cached
+
+    def __len__(self):
+        return len(self._cols.count)
+
+    def refresh(self, force=False):
+        # read records modified since the last refresh, if the cube is older than its TTL. Returns the number of records read.
+        if not force and self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.ttl:
+            return 0
+        with self._lock:
+            if not force and self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.ttl:
+                return 0  # another thread has just refreshed
+            refreshed_at = time.monotonic()
+            with stage("cube.refresh") as st:
+                docs, deleted = self._read()
+                if self.refreshed_at is not None and deleted is not None and deleted["seq"] - len(deleted["deleted"]) > self.deleted_seq:
+                    # deletions have been dropped from the log before the cube applied them
+                    self._reset()
+                    docs, deleted = self._read()
+                if len(docs) > 0 or deleted is not None:
+                    self._ingest(docs, deleted)
+                st.rows = len(docs)
+            self.refreshed_at = refreshed_at
+            return len(docs)
+
+    def _read(self):
+        # aggregate records modified since the last refresh, and the deletion log if it has changed.
+        # _ts has one-second resolution, so re-read the last second; replacement by id, and the deletion seq, make that harmless
+        docs = []
+        deleted = None
+        for doc in self.agg_store.modified_since(self.max_modified):
+            if doc["id"] == DELETED_ID:
+                deleted = doc
+            elif any(f in doc for f in period_fields):
+                docs.append(doc)
+        return docs, deleted
+
+    def _ingest(self, docs, deleted=None):
+        old = self._cols
+        n_old = len(old.count)
+        updates = []
+        new_ids = {}
+        for doc in docs:
+            self.max_modified = max(self.max_modified, doc.get("_ts", 0))
+            ix = self.row_ix.get(doc["id"], new_ids.get(doc["id"]))
+            if ix is None:
+                ix = new_ids[doc["id"]] = n_old + len(new_ids)
+            updates.append((ix, doc))
+
+        cols = _Columns()
+        n = n_old + len(new_ids)
+        for f in key_fields:
+            cols.keys[f] = np.concatenate([old.keys[f], np.zeros(n - n_old, dtype=np.int32)])
+        for name in ("period_field", "period", "tz", "count", "sessions", "start_ts", "has_sketch"):
+            a = getattr(old, name)
+            setattr(cols, name, np.concatenate([a, np.zeros(n - n_old, dtype=a.dtype)]))
+        cols.registers = np.concatenate([old.registers, np.zeros((M, n - n_old), dtype=np.uint8)], axis=1)
+
+        for ix, doc in updates:
+            for f in key_fields:
+                cols.keys[f][ix] = self.categories[f].code(doc.get(f, "-"))
+            period_field = next(f for f in period_fields if f in doc)
+            cols.period_field[ix] = period_fields.index(period_field)
+            cols.period[ix] = self.periods.code(doc[period_field])
+            cols.tz[ix] = self.zones.code(doc.get("tz"))
+            cols.count[ix] = doc.get("count", 0)
+            cols.sessions[ix] = doc.get("sessions", 0)
+            cols.start_ts[ix] = doc.get("start_ts", 0)
+            registers = registers_of(doc.get("sessions_hll"))
+            cols.has_sketch[ix] = registers is not None
+            cols.registers[:, ix] = 0 if registers is None else registers
+        self.row_ix.update(new_ids)
+
+        if deleted is not None:
+            self.max_modified = max(self.max_modified, deleted.get("_ts", 0))
+            drop = [self.row_ix.pop(item_id) for item_id, seq in deleted["deleted"] if seq > self.deleted_seq and item_id in self.row_ix]
+            self.deleted_seq = deleted["seq"]
+            if len(drop) > 0:
+                keep = np.ones(len(cols.count), dtype=bool)
+                keep[drop] = False
+                new_ix = np.cumsum(keep) - 1
+                self.row_ix = {item_id: int(new_ix[ix]) for item_id, ix in self.row_ix.items()}
+                cols = cols.take(np.flatnonzero(keep))
+        self._cols = cols
+
+    def _select(self, cols, period_field, start_ts, end_ts, equals=None, tz=None):
+        mask = (cols.period_field == period_fields.index(period_field)) & (cols.start_ts >= start_ts) & (cols.start_ts < end_ts)
+        if tz is not None:
+            code = self.zones.codes.get(tz)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            mask &= cols.tz == code
+        for field, value in (equals or {}).items():
+            code = self.categories[field].codes.get(value)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            mask &= cols.keys[field] == code
+        return np.flatnonzero(mask)
+
+    def values(self, field, equals=None):
+        # distinct values of a key field among the records, optionally with field = value filters
+        self.refresh()
+        cols = self._cols
+        mask = np.ones(len(cols.count), dtype=bool)
+        for f, value in (equals or {}).items():
+            code = self.categories[f].codes.get(value)
+            if code is None:
+                return []
+            mask &= cols.keys[f] == code
+        cats = self.categories[field].values
+        return [cats[c] for c in np.unique(cols.keys[field][mask])]
+
+    def series(self, period_field, start_ts, end_ts, metric, facet=None, equals=None, tz=None, top_n=None):
+        # the metric summed over each period (and facet value, if given) in the range; a DataFrame as groupby(...).sum().reset_index() would give.
+        # "sessions" are distinct sessions, from merged sketches. tz is required for "local_date".
+        # With top_n, only the top_n facet values by the metric summed over the range are kept, and the rest are grouped with a facet
+        # value of None (last), which cannot be confused with an actual value. Their sessions are merged like any other group, so are not
+        # over-counted; the ranking uses summed sessions.
+        self.refresh()
+        cols = self._cols
+        rows = self._select(cols, period_field, start_ts, end_ts, equals, tz)
+        columns = [period_field] + ([] if facet is None else [facet]) + [metric]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=columns)
+
+        # group on (period, facet) codes, ordered by the decoded values as groupby would
+        period_values, period_rank = self._decode(self.periods)
+        group_keys = period_rank[cols.period[rows]].astype(np.int64)
+        if facet is not None:
+            facet_values, facet_rank = self._decode(self.categories[facet])
+            facet_codes = cols.keys[facet][rows]
+            row_rank = facet_rank[facet_codes]
+            if top_n is not None:
+                totals = np.bincount(facet_codes, weights=getattr(cols, metric)[rows], minlength=len(facet_values))
+                present = np.flatnonzero(np.bincount(facet_codes, minlength=len(facet_values)))
+                if len(present) > top_n:
+                    # a stable sort on the negated totals keeps ties in code order, so the choice does not depend on the row order
+                    top = present[np.argsort(-totals[present], kind="stable")[:top_n]]
+                    row_rank = np.where(np.isin(facet_codes, top), row_rank, len(facet_values))  # other sorts last
+            group_keys = group_keys * (len(facet_values) + 1) + row_rank
+        uniq, first, inverse = np.unique(group_keys, return_index=True, return_inverse=True)
+
+        data = {period_field: period_values[cols.period[rows[first]]]}
+        if facet is not None:
+            data[facet] = np.where(row_rank[first] == len(facet_values), None, facet_values[facet_codes[first]])
+        if metric == "sessions":
+            order = np.argsort(inverse, kind="stable")
+            grouped = rows[order]
+            starts = np.searchsorted(inverse[order], np.arange(len(uniq)))
+            data[metric] = grouped_distinct_sessions(cols.sessions[grouped], np.take(cols.registers, grouped, axis=1), cols.has_sketch[grouped],
+                                                     starts)
+        else:
+            data[metric] = np.bincount(inverse, weights=getattr(cols, metric)[rows], minlength=len(uniq)).astype(np.int64)
+        return pd.DataFrame(data, columns=columns)
+
+    def range_sessions(self, period_field, start_ts, end_ts, equals=None, tz=None):
+        # distinct sessions over the whole range, from merged sketches
+        self.refresh()
+        cols = self._cols
+        rows = self._select(cols, period_field, start_ts, end_ts, equals, tz)
+        if len(rows) == 0:
+            return 0
+        return int(grouped_distinct_sessions(cols.sessions[rows], np.take(cols.registers, rows, axis=1), cols.has_sketch[rows],
+                                             np.zeros(1, dtype=np.int64))[0])
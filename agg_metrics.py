@@ -0,0 +1,142 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Instrumentation for the aggregator and the views: where the seconds and the Cosmos request units (RUs) go.
+# A stage is a named, timed section of work, e.g. "agg.raw_query" or "view.update_charts". When a stage ends, its wall time, the rows it
+# read, the records it wrote and the request charge of the Cosmos requests it made are added to process-wide counters (see snapshot(),
+# which the /metrics route returns) and emitted as a structured log record: a JSON message, also passed as "custom_dimensions".
+# Stages nest. A stage's request charge includes its sub-stages', and the log record of an outermost stage (e.g. one aggregator run or one
+# Dash callback) is at INFO with a breakdown of seconds and RUs by sub-stage; sub-stages log at DEBUG.
+# Request charges are reported by CosmosStore (from the "x-ms-request-charge" response header of every request, including each page of a
+# query) to the innermost stage active on the same thread. Work in other threads is attributed by passing the parent stage explicitly.
+# Counters are per process and reset when it restarts.
+
+recent_size = 256  # durations kept per stage for the latency percentiles
+
+
+class Stage:
+    def __init__(self, name, parent, fields):
+        self.name = name
+        self.parent = parent
+        self.fields = fields  # extra context for the log record, e.g. the hour
+        self.rows = 0
+        self.records = 0
+        self.ru = 0.0
+        self.excluded = 0.0
+        self.breakdown = {}  # sub-stage name (at any depth) -> [calls, seconds, ru], each including the sub-stage's own sub-stages
+
+    def exclude(self, seconds):
+        # time spent on other work inside the stage (recorded separately), e.g. grouping rows between pages of a query
+        self.excluded += seconds
+
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        # the innermost stage active on this thread, or None
+        stack = self._stack()
+        return stack[-1] if len(stack) > 0 else None
+
+    @contextmanager
+    def stage(self, name, parent=None, **fields):
+        stack = self._stack()
+        st = Stage(name, parent if parent is not None else self.current(), fields)
+        stack.append(st)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield st
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            self._finish(st, time.perf_counter() - start - st.excluded, error)
+
+    def add_charge(self, ru):
+        st = self.current()
+        with self._lock:
+            while st is not None:
+                st.ru += ru
+                st = st.parent
+
+    def record(self, name, seconds, rows=0, records=0, ru=0.0, error=None, parent=None):
+        # add to the counters for one stage, and to the breakdowns of the enclosing stages (by default, those active on this thread),
+        # without logging; for work timed by other means
+        parent = parent if parent is not None else self.current()
+        with self._lock:
+            c = self.counters.get(name)
+            if c is None:
+                c = self.counters[name] = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0, "records": 0, "ru": 0.0,
+                                           "recent": deque(maxlen=recent_size)}
+            c["calls"] += 1
+            c["errors"] += error is not None
+            c["seconds"] += seconds
+            c["max_seconds"] = max(c["max_seconds"], seconds)
+            c["rows"] += rows
+            c["records"] += records
+            c["ru"] += ru
+            c["recent"].append(seconds)
+            while parent is not None:
+                b = parent.breakdown.setdefault(name, [0, 0.0, 0.0])
+                b[0] += 1
+                b[1] += seconds
+                b[2] += ru
+                parent = parent.parent
+
+    def _finish(self, st, seconds, error):
+        self.record(st.name, seconds, st.rows, st.records, st.ru, error, parent=st.parent)
+        rec = {"stage": st.name, "seconds": round(seconds, 4), "rows": st.rows, "records": st.records, "ru": round(st.ru, 2), **st.fields}
+        if error is not None:
+            rec["error"] = error
+        if len(st.breakdown) > 0:
+            rec["breakdown"] = {name: {"calls": calls, "seconds": round(secs, 4), "ru": round(ru, 2)} for name, (calls, secs, ru) in st.breakdown.items()}
+        logging.log(logging.INFO if st.parent is None else logging.DEBUG, json.dumps(rec), extra={"custom_dimensions": rec})
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for name, c in sorted(self.counters.items()):
+                recent = sorted(c["recent"])
+                stages[name] = {k: round(v, 4) if isinstance(v, float) else v for k, v in c.items() if k != "recent"}
+                stages[name]["p50_ms"] = round(1000 * recent[len(recent) // 2], 2)
+                stages[name]["p95_ms"] = round(1000 * recent[min(len(recent) - 1, int(0.95 * len(recent)))], 2)
+        return {"started_at": self.started_at, "uptime_seconds": round(time.time() - self.started_at, 1), "stages": stages}
+
+    def timed(self, name):
+        # decorator: run the function as a stage, e.g. a Dash callback
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+metrics = Metrics()
+stage = metrics.stage
+timed = metrics.timed
+
+
+def cosmos_charge(headers, *args):
+    # response_hook for Cosmos SDK calls
+    charge = (headers or {}).get("x-ms-request-charge")
+    if charge is not None:
+        metrics.add_charge(float(charge))
@@ -0,0 +1,167 @@
+import io
+import json
+import threading
+import time
+from datetime import datetime as dt, timedelta
+from functools import wraps, lru_cache
+from hashlib import blake2b
+
+from flask import request, abort, jsonify, make_response
+
+from agg_metrics import stage
+from agg_store import WATERMARK_ID
+from agg_cube import key_fields
+from agg_charts import range_series
+
+try:
+    import pyarrow as pa  # optional; only needed for Arrow responses from the range query API
+except ImportError:
+    pa = None
+
+# The memoised range query shared by the Basic chart and the /series API, and the /series response itself. Kept apart from agg_view.py,
+# which sets up AnalyticsCore at import, so that it can be used with any AggStore (e.g. by the tests and the benchmark).
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def ttl_cache(ttl):
+    # Memoise a function's result, per positional arguments, for ttl seconds.
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+            if hit is not None and now - hit[0] < ttl:
+                return hit[1]
+            value = func(*args)
+            with lock:
+                cache[args] = (now, value)
+            return value
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+class SeriesCache:
+    # Grouped series from an AggCube, memoised in an LRU cache shared by all viewers. Entries are keyed on the data version, so a new
+    # aggregation makes new entries and the stale ones are evicted as the cache fills. ttl is how long the watermark is cached for.
+    def __init__(self, agg_store, cube, ttl=300, maxsize=256):
+        self.agg_store = agg_store
+        self.cube = cube
+        self._watermark_ts = ttl_cache(ttl)(self._read_watermark_ts)
+        self._range_query = lru_cache(maxsize=maxsize)(self._series)
+
+    def _read_watermark_ts(self):
+        with stage("view.watermark"):
+            doc = self.agg_store.read_item(WATERMARK_ID)
+        return None if doc is None else doc["watermark_ts"]
+
+    def _series(self, version, query):
+        with stage("view.range_series"):
+            return range_series(self.cube, *query)
+
+    def data_version(self):
+        # Changes whenever the aggregated data the views see changes: the aggregation watermark, and the latest modification the cube has
+        # loaded (which also covers re-aggregated hours, which do not move the watermark). Used for ETags and in the memo key.
+        self.cube.refresh()
+        return f"{self._watermark_ts()}-{self.cube.max_modified}"
+
+    def range_query(self, plaything_name, facet, filter_by, filter_value, start_date, end_date, metric, tz=None, top_n=None, version=None):
+        # Returns (data version, series); see agg_charts.range_series(). The result (including its DataFrame) is shared, so must not be
+        # modified. top_n=None does not collapse facet values.
+        version = version or self.data_version()
+        return version, self._range_query(version, (plaything_name, facet, filter_by, filter_value, start_date, end_date, metric, tz, top_n))
+
+    def cache_clear(self):
+        self._watermark_ts.cache_clear()
+        self._range_query.cache_clear()
+
+
+def series_etag(version, query, fmt):
+    return blake2b(json.dumps([version, *query, fmt]).encode(), digest_size=16).hexdigest()
+
+
+def _series_meta(series, version):
+    meta = {k: series[k] for k in ("period", "start_ts", "end_ts", "facet", "metric", "tz")}
+    meta["version"] = version
+    if "range_sessions" in series:
+        meta["range_sessions"] = series["range_sessions"]
+    return meta
+
+
+def series_json(series, version):
+    # columnar, i.e. {"data": {column: [values]}}, along with the period tier, range, etc.
+    df = series["df"]
+    return dict(_series_meta(series, version), data={c: df[c].tolist() for c in df.columns})
+
+
+def series_arrow(series, version):
+    # an Arrow IPC stream of the DataFrame, with the period tier, range, etc. as (JSON-encoded) schema metadata
+    table = pa.Table.from_pandas(series["df"], preserve_index=False)
+    table = table.replace_schema_metadata({k: json.dumps(v) for k, v in _series_meta(series, version).items()})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def series_response(series_cache, local_time_zones, facet_top_n):
+    # Range query API: the grouped series behind the Basic chart, as JSON or (with format=arrow, or an Accept header preferring Arrow) an
+    # Arrow IPC stream. Query string params, all optional: plaything_name, facet, filter_by and filter_value, metric ("count" or
+    # "sessions"), start_date and end_date (YYYY-MM-DD, default the last 7 days), tz (UTC, or one of the configured "local_time_zones")
+    # and top_n (the number of facet values before the rest are grouped as "other", with a null facet value; default "facet_top_n" from
+    # config, 0 for all).
+    # The ETag is derived from the aggregated data version and the query, so clients and proxies can revalidate (304) without the series
+    # being recomputed, and results are shared with the dashboard through the range_query() memo.
+    args = request.args
+    fmt = args.get("format")
+    if fmt is None:
+        fmt = "arrow" if request.accept_mimetypes.best_match(["application/json", ARROW_MIMETYPE]) == ARROW_MIMETYPE else "json"
+    if fmt not in ("json", "arrow"):
+        abort(400, "format must be json or arrow")
+    if fmt == "arrow" and pa is None:
+        abort(406, "Arrow responses are not available (pyarrow is not installed)")
+    end_date = args.get("end_date") or dt.utcnow().strftime("%Y-%m-%d")
+    start_date = args.get("start_date")
+    try:
+        start_date = start_date or (dt.strptime(end_date, "%Y-%m-%d") - timedelta(days=6)).strftime("%Y-%m-%d")
+        if dt.strptime(start_date, "%Y-%m-%d") > dt.strptime(end_date, "%Y-%m-%d"):
+            abort(400, "start_date is after end_date")
+    except ValueError:
+        abort(400, "dates must be YYYY-MM-DD")
+    facet = args.get("facet") or None
+    filter_by = args.get("filter_by") or None
+    metric = args.get("metric", "count")
+    tz = args.get("tz") or None
+    tz = None if tz == "UTC" else tz
+    if facet not in (None, *key_fields) or filter_by not in (None, *key_fields) or metric not in ("count", "sessions"):
+        abort(400, "unknown facet, filter_by or metric")
+    if tz is not None and tz not in local_time_zones:
+        abort(400, "tz must be UTC or one of the configured local time zones")
+    top_n = args.get("top_n", str(facet_top_n))
+    if not top_n.isdigit():
+        abort(400, "top_n must be a whole number")
+    top_n = int(top_n)
+    query = (args.get("plaything_name") or None, facet, filter_by, args.get("filter_value") if filter_by is not None else None,
+             start_date, end_date, metric, tz, top_n or None)
+
+    with stage("view.series_api", format=fmt) as st:
+        version = series_cache.data_version()
+        etag = series_etag(version, query, fmt)
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            _, result = series_cache.range_query(*query, version=version)
+            if fmt == "arrow":
+                response = make_response(series_arrow(result, version))
+                response.mimetype = ARROW_MIMETYPE
+            else:
+                response = jsonify(series_json(result, version))
+            st.rows = len(result["df"])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, no-cache"  # may be stored, but revalidate
+    return response
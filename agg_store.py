@@ -0,0 +1,322 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from azure.cosmos import exceptions
+
+from agg_metrics import cosmos_charge
+
+# Storage back-ends for the raw activity and aggregated record containers.
+# The aggregator and the views only need a handful of operations, so they talk to an AggStore rather than building Cosmos SQL:
+# - query(): records with ts_field in [start_ts, end_ts), optionally restricted to some fields, field = value filters, and a field which must be defined
+# - distinct_values(): the distinct values of one field, optionally with field = value filters
+# - max_value() / min_value(): aggregate over one field; None if there are no records (or the field is never defined)
+# - write_many(): store a list of records. Records with an id are upserted, so re-writing them is idempotent; others are created with a new id.
+#   For Cosmos, records are written as transactional batches (up to 100 operations per batch, all with the same partition_key) and
+#   throttled (429) requests are retried with backoff.
+#   An optional checkpoint document is upserted in the final batch, so it is only updated once all of the records have been written.
+# - read_item() / delete_item(): point operations on one document by id. read_item() returns None if it does not exist.
+# - read_changes(): a ChangeFeed of documents created or updated since a continuation token (see below)
+# - modified_since(): all documents whose system timestamp (_ts) is at or after a timestamp; used to refresh in-memory copies
+# AggStore and ChangeFeed are abstract, so a back-end missing an operation fails when it is constructed.
+# CosmosStore wraps a container from AnalyticsCore, and reports the request charge of every request to agg_metrics (see agg_metrics.py).
+# SQLiteStore is a local stand-in (in-memory by default, or a file) which is used for profiling and load testing the aggregator and
+# dashboard without a Cosmos account. It stores each record as JSON with the ts_field pulled out into an indexed column, so it will hold
+# tens of millions of synthetic activity rows when given a file path.
+
+# ids of bookkeeping documents kept in the agg container alongside the aggregate records
+WATERMARK_ID = "agg-watermark"  # "watermark_ts" is the start of the latest hour for which aggregation is complete
+CHANGE_FEED_ID = "agg-change-feed"  # "continuation" is the activity change feed token that incremental aggregation has processed up to
+DISTINCT_INDEX_ID = "agg-distinct-values"  # distinct values of the key fields: "fields" {field: values} and "by_plaything" {name: {field: values}}
+DELETED_ID = "agg-deleted"  # "deleted" [[id, seq]] of the latest aggregate records deleted, and "seq" the number of deletions so far
+
+_field_re = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def check_field(field):
+    # field names are interpolated into queries so only allow plain identifiers (some come from Dash callback inputs)
+    if not isinstance(field, str) or _field_re.match(field) is None:
+        raise ValueError(f"Invalid field name: {field!r}")
+    return field
+
+
+class AggStore(ABC):
+    def __init__(self, ts_field):
+        self.ts_field = check_field(ts_field)
+
+    @abstractmethod
+    def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def distinct_values(self, field, equals=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def max_value(self, field):
+        raise NotImplementedError
+
+    @abstractmethod
+    def min_value(self, field):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_many(self, records, checkpoint=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_item(self, item_id, partition_key="1"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_item(self, item_id, partition_key="1"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_changes(self, continuation=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def modified_since(self, ts):
+        raise NotImplementedError
+
+
+class ChangeFeed(ABC):
+    # Iterate over this for the documents created or updated since the continuation token (None starts from now, i.e. yields nothing).
+    # Once iteration is complete, continuation holds the token to persist and pass to the next read_changes().
+    def __init__(self, continuation):
+        self.continuation = continuation
+
+    @abstractmethod
+    def __iter__(self):
+        raise NotImplementedError
+
+
+class _CosmosChangeFeed(ChangeFeed):
+    def __init__(self, container, continuation):
+        super().__init__(continuation)
+        self.container = container
+
+    def __iter__(self):
+        if self.continuation is None:
+            items = self.container.query_items_change_feed(start_time="Now", response_hook=cosmos_charge)
+        else:
+            items = self.container.query_items_change_feed(continuation=self.continuation, response_hook=cosmos_charge)
+        yield from items
+        self.continuation = self.container.client_connection.last_response_headers.get("etag")
+
+
+class _SQLiteChangeFeed(ChangeFeed):
+    # the rowid order stands in for the change feed; INSERT OR REPLACE gives a replaced document a new rowid, like a Cosmos update
+    def __init__(self, store, continuation):
+        super().__init__(continuation)
+        self.store = store
+
+    def __iter__(self):
+        if self.continuation is None:
+            self.continuation = str(self.store._fetch("SELECT COALESCE(MAX(rowid), 0) FROM items", [])[0][0])
+            return
+        last_rowid = int(self.continuation)
+        for rowid, doc in self.store._iterate("SELECT rowid, doc FROM items WHERE rowid > ? ORDER BY rowid", [last_rowid]):
+            last_rowid = rowid
+            yield json.loads(doc)
+        self.continuation = str(last_rowid)
+
+
+class CosmosStore(AggStore):
+    max_batch_size = 100  # Cosmos limit on operations in one transactional batch
+    max_retries = 8
+
+    def __init__(self, container, ts_field="start_ts"):
+        super().__init__(ts_field)
+        self.container = container
+
+    def _with_retry(self, func, *args, **kwargs):
+        # retry throttled requests, waiting for the retry-after time which Cosmos supplies, or with exponential backoff if it does not
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                if e.status_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after_ms = (getattr(e, "headers", None) or {}).get("x-ms-retry-after-ms")
+                wait = float(retry_after_ms) / 1000 if retry_after_ms is not None else 0.1 * 2 ** attempt
+                logging.info(f"Cosmos request throttled; retrying in {wait:.2f}s.")
+                time.sleep(wait)
+
+    def _query(self, qry, parameters=None):
+        return self.container.query_items(qry, parameters=parameters, enable_cross_partition_query=True, response_hook=cosmos_charge)
+
+    @staticmethod
+    def _where(equals, defined, parts=None, parameters=None):
+        parts = [] if parts is None else parts
+        parameters = [] if parameters is None else parameters
+        if defined is not None:
+            parts.append(f"IS_DEFINED(c.{check_field(defined)})")
+        for field, value in (equals or {}).items():
+            name = f"@p{len(parameters)}"
+            parts.append(f"c.{check_field(field)} = {name}")
+            parameters.append({"name": name, "value": value})
+        return (" WHERE " + " AND ".join(parts)) if parts else "", parameters
+
+    def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+        select = "*" if fields is None else ", ".join(f"c.{check_field(f)}" for f in fields)
+        where, parameters = self._where(equals, defined,
+                                        parts=[f"c.{self.ts_field} >= @start_ts", f"c.{self.ts_field} < @end_ts"],
+                                        parameters=[{"name": "@start_ts", "value": start_ts}, {"name": "@end_ts", "value": end_ts}])
+        return self._query(f"SELECT {select} FROM c{where}", parameters)
+
+    def distinct_values(self, field, equals=None):
+        where, parameters = self._where(equals, None)
+        return list(self._query(f"SELECT DISTINCT VALUE c.{check_field(field)} FROM c{where}", parameters))
+
+    def max_value(self, field):
+        return next(iter(self._query(f"SELECT VALUE MAX(c.{check_field(field)}) FROM c")), None)
+
+    def min_value(self, field):
+        return next(iter(self._query(f"SELECT VALUE MIN(c.{check_field(field)}) FROM c")), None)
+
+    def write_many(self, records, checkpoint=None):
+        # group by partition key, since a transactional batch may only span one logical partition. Batch operations do not generate ids.
+        by_partition = {}
+        n = 0
+        for rec in records:
+            if "partition_key" not in rec:
+                self._with_retry(self.container.create_item, rec, enable_automatic_id_generation=True, response_hook=cosmos_charge)
+            elif "id" in rec:
+                by_partition.setdefault(rec["partition_key"], []).append(("upsert", (rec,)))
+            else:
+                by_partition.setdefault(rec["partition_key"], []).append(("create", (dict(rec, id=str(uuid.uuid4())),)))
+            n += 1
+        if checkpoint is not None:
+            # the checkpoint goes last, in the same batch as the final records of its partition
+            operations = by_partition.pop(checkpoint["partition_key"], [])
+            operations.append(("upsert", (checkpoint,)))
+            by_partition[checkpoint["partition_key"]] = operations
+        for partition_key, operations in by_partition.items():
+            for i in range(0, len(operations), self.max_batch_size):
+                self._with_retry(self.container.execute_item_batch, operations[i:i + self.max_batch_size], partition_key=partition_key,
+                                 response_hook=cosmos_charge)
+        return n
+
+    def read_item(self, item_id, partition_key="1"):
+        try:
+            return self._with_retry(self.container.read_item, item_id, partition_key=partition_key, response_hook=cosmos_charge)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def delete_item(self, item_id, partition_key="1"):
+        try:
+            self._with_retry(self.container.delete_item, item_id, partition_key=partition_key, response_hook=cosmos_charge)
+            return True
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+
+    def read_changes(self, continuation=None):
+        return _CosmosChangeFeed(self.container, continuation)
+
+    def modified_since(self, ts):
+        return self._query("SELECT * FROM c WHERE c._ts >= @ts", [{"name": "@ts", "value": ts}])
+
+
+class SQLiteStore(AggStore):
+    def __init__(self, path=":memory:", ts_field="start_ts"):
+        super().__init__(ts_field)
+        self.path = path
+        # the aggregator and Flask may use the store from more than one thread; sqlite3 connections are not shareable without a lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self.conn:
+            if path != ":memory:":
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=OFF")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, ts INTEGER, doc TEXT NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS items_ts ON items (ts)")
+
+    @staticmethod
+    def _where(equals, defined, parts=None, parameters=None):
+        parts = [] if parts is None else parts
+        parameters = [] if parameters is None else parameters
+        if defined is not None:
+            parts.append(f"json_type(doc, '$.{check_field(defined)}') IS NOT NULL")
+        for field, value in (equals or {}).items():
+            parts.append(f"json_extract(doc, '$.{check_field(field)}') = ?")
+            parameters.append(value)
+        return (" WHERE " + " AND ".join(parts)) if parts else "", parameters
+
+    def _fetch(self, sql, parameters):
+        with self._lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def _iterate(self, sql, parameters, page_size=10000):
+        # stream results in pages, rather than fetchall(), so that a large time range is not materialised at once
+        with self._lock:
+            cursor = self.conn.execute(sql, parameters)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield from rows
+
+    def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+        where, parameters = self._where(equals, defined, parts=["ts >= ?", "ts < ?"], parameters=[start_ts, end_ts])
+        if fields is None:
+            return (json.loads(doc) for doc, in self._iterate(f"SELECT doc FROM items{where}", parameters))
+        fields = [check_field(f) for f in fields]
+        select = ", ".join(f"json_extract(doc, '$.{f}')" for f in fields)
+        # like Cosmos, fields which are not defined in a record are omitted from the result
+        return ({f: v for f, v in zip(fields, row) if v is not None} for row in self._iterate(f"SELECT {select} FROM items{where}", parameters))
+
+    def distinct_values(self, field, equals=None):
+        where, parameters = self._where(equals, check_field(field))
+        return [v for v, in self._fetch(f"SELECT DISTINCT json_extract(doc, '$.{field}') FROM items{where}", parameters)]
+
+    def _aggregate(self, func, field):
+        if field == self.ts_field:
+            sql = f"SELECT {func}(ts) FROM items"
+        else:
+            sql = f"SELECT {func}(json_extract(doc, '$.{check_field(field)}')) FROM items"
+        return self._fetch(sql, [])[0][0]
+
+    def max_value(self, field):
+        return self._aggregate("MAX", field)
+
+    def min_value(self, field):
+        return self._aggregate("MIN", field)
+
+    def _row(self, rec, now_ts):
+        # mimic the Cosmos system timestamp and id generation, but keep any supplied _ts (synthetic activity data sets its own)
+        rec = dict(rec)
+        rec.setdefault("_ts", now_ts)
+        rec.setdefault("id", str(uuid.uuid4()))
+        return rec["id"], rec.get(self.ts_field), json.dumps(rec)
+
+    def write_many(self, records, checkpoint=None):
+        now_ts = int(time.time())
+        rows = [self._row(rec, now_ts) for rec in records]
+        # one transaction, so the checkpoint and records are written together
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO items (id, ts, doc) VALUES (?, ?, ?)", rows)
+            if checkpoint is not None:
+                self.conn.execute("INSERT OR REPLACE INTO items (id, ts, doc) VALUES (?, ?, ?)", self._row(checkpoint, now_ts))
+        return len(rows)
+
+    def read_item(self, item_id, partition_key="1"):
+        rows = self._fetch("SELECT doc FROM items WHERE id = ?", [item_id])
+        return json.loads(rows[0][0]) if rows else None
+
+    def delete_item(self, item_id, partition_key="1"):
+        with self._lock, self.conn:
+            return self.conn.execute("DELETE FROM items WHERE id = ?", [item_id]).rowcount > 0
+
+    def read_changes(self, continuation=None):
+        return _SQLiteChangeFeed(self, continuation)
+
+    def modified_since(self, ts):
+        return (json.loads(doc) for doc, in self._iterate("SELECT doc FROM items WHERE json_extract(doc, '$._ts') >= ?", [ts]))
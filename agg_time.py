@@ -0,0 +1,31 @@
+from datetime import datetime as dt, timezone
+
+# Time helpers shared by the aggregator and the views: UTC "date_hr" values, local day and week/month period bounds.
+# All timestamps are UTC seconds.
+
+
+def date_hr_of(ts):
+    return dt.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H")
+
+
+def ts_of_date_hr(date_hr):
+    return int(dt.strptime(date_hr, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc).timestamp())
+
+
+def local_day_start(zone, local_date):
+    # start of the first UTC hour which starts on a local date. For zones with whole-hour offsets this is local midnight. Otherwise (e.g.
+    # India, +05:30) hours are assigned to the local date on which they start, since hour records cannot be split.
+    midnight_ts = int(dt.combine(local_date, dt.min.time(), tzinfo=zone).timestamp())
+    return -3600 * (-midnight_ts // 3600)
+
+
+def period_bounds(period_field, d_start_ts):
+    # the ISO week ("2024-W05", starting Monday) or calendar month ("2024-01") containing a day, with its start and end timestamps
+    day = dt.fromtimestamp(d_start_ts, tz=timezone.utc)
+    if period_field == "week":
+        iso = day.isocalendar()
+        start_ts = d_start_ts - 86400 * (iso.weekday - 1)
+        return f"{iso.year}-W{iso.week:02d}", start_ts, start_ts + 7 * 86400
+    start = day.replace(day=1)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.strftime("%Y-%m"), int(start.timestamp()), int(end.timestamp())
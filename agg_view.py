@@ -1,4 +1,8 @@
 from pg_shared import LangstringsBase, AnalyticsCore
+from agg_metrics import stage
+from agg_store import CosmosStore, DISTINCT_INDEX_ID
+from agg_cube import AggCube
+from agg_series import SeriesCache, ttl_cache
 
 # Some central stuff which is used by both plain Flask and Dash views.
 # This is basically the same as the plaything formula but "analytics things" differ in not having the concept of a specification.
@@ -25,6 +29,9 @@ class Langstrings(LangstringsBase):
         },
         "FILTER_BY": {
             "en": "Filter by:"
+        },
+        "TIME_ZONE": {
+            "en": "Time zone:"
         }
         
     }
@@ -41,4 +48,40 @@ menu = {
 }
 
 # This sets up core features such as logger, activity recording, core-config.
-core = AnalyticsCore(AT_NAME)
\ No newline at end of file
+core = AnalyticsCore(AT_NAME)
+
+# Views read aggregated records through this rather than querying core.aggregated_container directly (see agg_store.py)
+agg_store = CosmosStore(core.aggregated_container, ts_field="start_ts")
+# In-memory copy of the aggregated records for the charts (see agg_cube.py). Loaded on first use, then refreshed when older than the TTL.
+agg_cube = AggCube(agg_store, ttl=core.activity_config.get("cube_ttl_seconds", 300))
+# IANA time zones which the aggregator makes local day records for, and so which the views can show dates in (besides UTC)
+local_time_zones = core.activity_config.get("local_time_zones", [])
+# facets are limited to this many values (by the metric over the range) plus "other", which bounds the chart size
+facet_top_n = core.activity_config.get("facet_top_n", 10)
+
+
+@ttl_cache(core.activity_config.get("distinct_ttl_seconds", 300))
+def _distinct_index():
+    # the distinct value index maintained by the aggregator; a point-read, so no scan on page load or when filters change
+    with stage("view.distinct_index"):
+        return agg_store.read_item(DISTINCT_INDEX_ID)
+
+
+@ttl_cache(core.activity_config.get("distinct_ttl_seconds", 300))
+def distinct_values(field, plaything_name=None):
+    # Distinct values of one of the aggregated key fields, optionally for one plaything. Falls back to a scan if the aggregator
+    # has not yet created the index.
+    index = _distinct_index()
+    if index is None:
+        equals = None if plaything_name is None else {"plaything_name": plaything_name}
+        return sorted(agg_store.distinct_values(field, equals=equals))
+    if plaything_name is None:
+        return index["fields"].get(field, [])
+    return index["by_plaything"].get(plaything_name, {}).get(field, [])
+
+
+# The range query memo shared by the chart and the range query API (see agg_series.py)
+series_cache = SeriesCache(agg_store, agg_cube, ttl=core.activity_config.get("cube_ttl_seconds", 300),
+                           maxsize=core.activity_config.get("range_cache_size", 256))
+data_version = series_cache.data_version
+range_query = series_cache.range_query
@@ -1,85 +1,622 @@
-from pg_shared import AnalyticsCore
+import json
 import logging
-from datetime import datetime as dt
-import pandas as pd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from datetime import datetime as dt, timedelta
+from hashlib import blake2b
+from zoneinfo import ZoneInfo
+
+from agg_metrics import metrics, stage
+from agg_time import date_hr_of, ts_of_date_hr, local_day_start, period_bounds
+from agg_store import CosmosStore, WATERMARK_ID, CHANGE_FEED_ID, DISTINCT_INDEX_ID, DELETED_ID
+from session_sketch import SessionSketch, bounded_estimate
 
 # Aggregate count (and unique session ids) broken down by "tag", "plaything_name", "plaything_part", "specification_id", and storing to "agg-container" (see core_config.json)
 # Aggregates are for one hour and one day, and date/times are UTC (Cosmos DB is not localised). i.e. the date roll-over is UTC. 
-# TODO add a time zone so that the aggregated dates/times are Localised. i.e. assume that someone who wants a specific time zone will host a separate playground 
+# Local days for the IANA time zones listed in "local_time_zones" (e.g. ["Europe/London"]) are rolled up from the UTC hour records, as
+# "local_date" records with a "tz" field; see LocalDayAccumulator. These are a separate tier from "date", so nothing is counted twice.
 
 # This is meant to be called hourly and will fill up "max_agg_hours" (set in core_config.json) of missing entries.
 # If there are no raw records for an hour, then an aggregate record with "tag", "plaything_name", "plaything_part", and "specification_id" all set to "-" and counts of 0 is saved.
 # Otherwise, aggregate records for that hour are only created for those "tag", "plaything_name", "plaything_part", or "specification_id" with at least 1 raw record.
-# Date records are created whenever an "dateT23" is computed.
+# Date records are created whenever an "dateT23" is computed. Day totals are accumulated in memory as hour records are produced (see DayAccumulator).
+# ISO week ("week") and calendar month ("month") totals are likewise accumulated from the day records, and their records written each time a
+# day completes, so the current week and month records are partial until the period ends (see rollup_day()).
+# Each record also carries "sessions_hll", a mergeable sketch of its session ids (see session_sketch.py). Day "sessions" are estimated from
+# the merged hour sketches, rather than summed, so sessions which span hours are not over-counted.
+# Raw rows are streamed into an HourAccumulator per hour rather than being loaded into a DataFrame.
+# Missing hours are read in windows of up to "backfill_window_hours" (default 24) using one raw query per window; rows are bucketed by hour
+# in a single pass and all of the hour (and day) records for the window are written from that scan. The window size bounds memory use.
+# Alternatively, with "agg_workers" > 1, hours are aggregated in parallel by a thread pool (see aggregate_hours_parallel()).
+# Progress is recorded in a watermark document (id WATERMARK_ID) in the agg container, which is upserted in the same transactional batch as
+# the last records for each hour, and read at the start with a point-read. Scanning for MAX(date_hr) is only a recovery path if it is missing.
+# Records have deterministic ids (see record_id()) and are upserted, so re-aggregating an hour or day replaces its records.
+# With "agg_engine" set to "change_feed" in the config, the activity change feed is also read (from a continuation token persisted in the
+# CHANGE_FEED_ID document) and any already-aggregated hours with late-arriving activity are re-aggregated, along with their day records.
+# The distinct values of the key fields (overall and per plaything) are maintained in a DISTINCT_INDEX_ID document for the views' dropdowns.
+# Deleted records (superseded nil activity records, and records left from before ids were deterministic) are logged in a DELETED_ID document
+# so that the views' in-memory copy of the container drops them too; see delete_records().
+# The containers are accessed through AggStore (see agg_store.py). Normally these wrap the Cosmos containers from AnalyticsCore, but
+# stores and config may be passed in, e.g. SQLiteStore instances for profiling and load testing without a Cosmos account.
+# Each run is instrumented (see agg_metrics.py) with stages for the watermark lookup ("agg.watermark"), the raw query ("agg.raw_query"),
+# grouping rows by hour and key ("agg.grouping"), writes ("agg.write") and day rollups ("agg.day_rollup"), within "agg.run".
+
+key_fields = ("tag", "plaything_name", "plaything_part", "specification_id")
+raw_fields = list(key_fields) + ["session_id"]
+
+
+def record_id(period_field, period, key):
+    # deterministic id for the record of one key in one period. Hashed since key values may contain characters which are not allowed in ids
+    return blake2b(json.dumps([period_field, period, *key]).encode(), digest_size=16).hexdigest()
+
+
+nil_key = ("-", "-", "-", "-")
+rollup_tiers = ["week", "month"]  # tiers rolled up from day records
+deleted_log_size = 10000  # deletions kept in the DELETED_ID document
+
+
+class HourAccumulator:
+    # Streaming equivalent of DataFrame(rows).fillna("-").groupby(key_fields) for one hour. Rows are consumed one at a time and only a
+    # count and a set of session ids are kept per key, so memory scales with the number of distinct keys, not the number of rows.
+    __slots__ = ("counts", "sessions")
+
+    def __init__(self):
+        self.counts = {}
+        self.sessions = {}
+
+    def add(self, row):
+        get = row.get
+        key = (get("tag"), get("plaything_name"), get("plaything_part"), get("specification_id"))
+        if None in key:
+            key = tuple("-" if v is None else v for v in key)
+        session_id = get("session_id")
+        if key in self.counts:
+            self.counts[key] += 1
+            self.sessions[key].add("-" if session_id is None else session_id)
+        else:
+            self.counts[key] = 1
+            self.sessions[key] = {"-" if session_id is None else session_id}
+
+    def records(self, start_ts):
+        # aggregate records for the hour (in key order, as groupby would), or a nil activity record if there were no rows
+        dh = date_hr_of(start_ts)
+        if len(self.counts) == 0:
+            return [{"tag": "-", "plaything_name": "-", "plaything_part": "-", "specification_id": "-", "date_hr": dh, "count": 0, "sessions": 0,
+                     "sessions_hll": SessionSketch().to_string(), "start_ts": start_ts, "partition_key": "1", "id": record_id("date_hr", dh, nil_key)}]
+        recs = []
+        for key in sorted(self.counts):
+            rec = dict(zip(key_fields, key))
+            rec["id"] = record_id("date_hr", dh, key)
+            sessions = self.sessions[key]
+            rec.update({"date_hr": dh, "count": self.counts[key], "sessions": len(sessions), "sessions_hll": SessionSketch().update(sessions).to_string(),
+                        "start_ts": start_ts, "partition_key": "1"})  # force single partition
+            recs.append(rec)
+        return recs
+
+
+class RollupAccumulator:
+    # Totals of lower-tier records (hours or days) for one period of a coarser tier ("date", "week" or "month").
+    def __init__(self, period_field, period, start_ts):
+        self.period_field = period_field
+        self.period = period
+        self.start_ts = start_ts
+        self.covered = set()  # start_ts of the records added
+        self.totals = {}
+
+    def add_records(self, recs):
+        for rec in recs:
+            self.covered.add(rec["start_ts"])
+            # zero-hour placeholders (and other "-" plaything entries) are not included in sums
+            if rec["plaything_name"] == "-":
+                continue
+            key = tuple(rec[f] for f in key_fields)
+            # records aggregated before sketches were stored have no "sessions_hll"; the sessions is then a sum
+            sketch = rec.get("sessions_hll")
+            sketch = None if sketch is None else SessionSketch.from_string(sketch)
+            total = self.totals.get(key)
+            if total is None:
+                self.totals[key] = [rec["count"], rec["sessions"], rec["sessions"], sketch]
+            else:
+                total[0] += rec["count"]
+                total[1] += rec["sessions"]
+                total[2] = max(total[2], rec["sessions"])
+                total[3] = None if (sketch is None or total[3] is None) else total[3].merge(sketch)
+
+    def records(self):
+        # if there are only "-" plaything entries for the period, they are all "nil activity" records
+        if len(self.totals) == 0:
+            return [{"tag": "-", "plaything_name": "-", "plaything_part": "-", "specification_id": "-", self.period_field: self.period, "start_ts": self.start_ts,
+                     "count": 0, "sessions": 0, "sessions_hll": SessionSketch().to_string(), "partition_key": "1", "id": record_id(self.period_field, self.period, nil_key)}]
+        recs = []
+        for key in sorted(self.totals):
+            rec = dict(zip(key_fields, key))
+            rec["id"] = record_id(self.period_field, self.period, key)
+            count, sum_sessions, max_sessions, sketch = self.totals[key]
+            rec.update({"count": count, "sessions": bounded_estimate(sketch, max_sessions, sum_sessions), self.period_field: self.period,
+                        "start_ts": self.start_ts, "partition_key": "1"})  # force single partition
+            if sketch is not None:
+                rec["sessions_hll"] = sketch.to_string()
+            recs.append(rec)
+        return recs
+
+
+class DayAccumulator(RollupAccumulator):
+    # Running day totals, fed with hour records as they are produced, so that the day record usually needs no extra query.
+    # Hours which were aggregated in an earlier invocation of aggregator() are read back from the agg container when the day completes.
+    def __init__(self, d_start_ts):
+        super().__init__("date", date_hr_of(d_start_ts)[:10], d_start_ts)
+        self.end_ts = d_start_ts + 24 * 3600
+
+    def fill_missing(self, agg_store):
+        # query the agg container for the hours of the day not produced by this invocation; returns the number of hours read
+        missing = [h for h in range(self.start_ts, self.end_ts, 3600) if h not in self.covered]
+        if len(missing) == 0:
+            return 0
+        missing_set = set(missing)
+        recs = agg_store.query(missing[0], missing[-1] + 3600, defined="date_hr", fields=list(key_fields) + ["count", "sessions", "sessions_hll", "start_ts"])
+        self.add_records(rec for rec in recs if rec["start_ts"] in missing_set)
+        return len(missing)
+
+
+class LocalDayAccumulator(DayAccumulator):
+    # Totals for a day in a local time zone, containing the 24 UTC hours (23 or 25 when daylight saving time starts or ends) which start on
+    # that local date. Records have "local_date" and "tz" fields.
+    def __init__(self, tz, hour_ts):
+        zone = ZoneInfo(tz)
+        local_date = dt.fromtimestamp(hour_ts, tz=zone).date()
+        RollupAccumulator.__init__(self, "local_date", local_date.isoformat(), local_day_start(zone, local_date))
+        self.end_ts = local_day_start(zone, local_date + timedelta(days=1))
+        self.tz = tz
+
+    def records(self):
+        recs = super().records()
+        for rec in recs:
+            rec["tz"] = self.tz
+            rec["id"] = record_id("local_date", f"{self.tz} {self.period}", tuple(rec[f] for f in key_fields))
+        return recs
+
+
+class PeriodAccumulator(RollupAccumulator):
+    # Running totals for the week or month containing a day, fed with day records as they are made.
+    def __init__(self, period_field, d_start_ts):
+        period, start_ts, self.end_ts = period_bounds(period_field, d_start_ts)
+        super().__init__(period_field, period, start_ts)
+
+
+def fill_periods(agg_store, accs, end_ts):
+    # add the day records before end_ts which week and month accumulators do not have yet, read from the agg container with one query
+    accs = [acc for acc in accs if acc.start_ts < end_ts]
+    if len(accs) == 0:
+        return
+    covered = [set(acc.covered) for acc in accs]
+    for rec in agg_store.query(min(acc.start_ts for acc in accs), end_ts, defined="date", fields=list(key_fields) + ["count", "sessions", "sessions_hll", "start_ts"]):
+        for acc, skip in zip(accs, covered):
+            if acc.start_ts <= rec["start_ts"] < acc.end_ts and rec["start_ts"] not in skip:
+                acc.add_records([rec])
+
+
+def rollup_day(agg_store, accs, day_recs):
+    # Add a day's records to running totals for the week and month containing it, and return their records, so that week and month records
+    # are kept up to date as each day completes rather than only once they end. Days must be rolled up in order. The accumulators are kept
+    # in accs, by tier, between calls; when one is made, the earlier days of its period, which were rolled up by an earlier invocation of
+    # aggregator(), are read back from the agg container (with one query for both tiers, and none if the period starts on this day).
+    d_start_ts = day_recs[0]["start_ts"]
+    new_accs = []
+    for period_field in rollup_tiers:
+        acc = accs.get(period_field)
+        if acc is None or not (acc.start_ts <= d_start_ts < acc.end_ts):
+            acc = accs[period_field] = PeriodAccumulator(period_field, d_start_ts)
+            new_accs.append(acc)
+    fill_periods(agg_store, new_accs, d_start_ts)
+
+    recs = []
+    for period_field in rollup_tiers:
+        acc = accs[period_field]
+        # if the period's earlier days (read back, or rolled up in this invocation) were all nil, a nil activity record was written for it
+        was_nil = len(acc.covered) > 0 and len(acc.totals) == 0
+        acc.add_records(day_recs)
+        if was_nil and len(acc.totals) > 0:
+            # this day has the period's first activity, so its nil activity record must go
+            delete_records(agg_store, [(record_id(period_field, acc.period, nil_key), "1")])
+        recs += acc.records()
+    return recs
+
+
+class DistinctIndex:
+    # The distinct values of each key field, overall and per plaything, as they would be found by SELECT DISTINCT VALUE over the records.
+    # The document is saved before the records which introduce new values are written, so it is never missing values which are present.
+    # If the document is missing, it is rebuilt by scanning (a recovery path; this costs one query per field and per plaything).
+    def __init__(self, agg_store):
+        self.agg_store = agg_store
+        doc = agg_store.read_item(DISTINCT_INDEX_ID)
+        if doc is None:
+            logging.info("No distinct value index found; rebuilding it.")
+            doc = self._scan()
+        self.fields = {f: set(doc["fields"].get(f, [])) for f in key_fields}
+        self.by_plaything = {pn: {f: set(values) for f, values in pt_fields.items()} for pn, pt_fields in doc["by_plaything"].items()}
+
+    def _scan(self):
+        fields = {f: self.agg_store.distinct_values(f) for f in key_fields}
+        by_plaything = {pn: {f: self.agg_store.distinct_values(f, equals={"plaything_name": pn}) for f in key_fields if f != "plaything_name"}
+                        for pn in fields["plaything_name"]}
+        return {"fields": fields, "by_plaything": by_plaything}
+
+    def add(self, recs):
+        # returns True if there were new values
+        changed = False
+        for rec in recs:
+            for f in key_fields:
+                if rec[f] not in self.fields[f]:
+                    self.fields[f].add(rec[f])
+                    changed = True
+            pt_fields = self.by_plaything.setdefault(rec["plaything_name"], {f: set() for f in key_fields if f != "plaything_name"})
+            for f, values in pt_fields.items():
+                if rec[f] not in values:
+                    values.add(rec[f])
+                    changed = True
+        return changed
+
+    def save(self):
+        doc = {"id": DISTINCT_INDEX_ID, "partition_key": "1",
+               "fields": {f: sorted(values) for f, values in self.fields.items()},
+               "by_plaything": {pn: {f: sorted(values) for f, values in pt_fields.items()} for pn, pt_fields in self.by_plaything.items()}}
+        write_records(self.agg_store, [doc])
+
+
+def watermark_doc(hour_ts, zones):
+    # "tiers" records which rollup tiers exist for all complete periods up to the watermark, and "zones" the time zones with local days
+    return {"id": WATERMARK_ID, "partition_key": "1", "watermark_ts": hour_ts, "tiers": rollup_tiers, "zones": zones}
+
+
+def backfill_rollups(agg_store, start_ts, zones):
+    # Week and month records for all of the day records before start_ts, e.g. made before those tiers existed. One scan of the day tier.
+    logging.info("Rolling up week and month records from existing day records.")
+    accs = {}
+    for rec in agg_store.query(0, start_ts, defined="date", fields=list(key_fields) + ["count", "sessions", "sessions_hll", "start_ts"]):
+        for period_field in rollup_tiers:
+            period, period_start_ts, _ = period_bounds(period_field, rec["start_ts"])
+            acc = accs.get((period_field, period))
+            if acc is None:
+                acc = accs[(period_field, period)] = RollupAccumulator(period_field, period, period_start_ts)
+            acc.add_records([rec])
+    write_records(agg_store, [rec for acc in accs.values() for rec in acc.records()], checkpoint=watermark_doc(start_ts - 3600, zones))
+
+
+def backfill_local_days(agg_store, zones, start_ts, done_zones):
+    # Local day records for time zones which have been added to the config, from the existing hour records before start_ts. The hour tier
+    # is read a week at a time, and local days are written as they complete, which bounds memory.
+    logging.info(f"Rolling up local day records for {', '.join(zones)} from existing hour records.")
+    first_ts = agg_store.min_value("start_ts")
+    accs = {}
+    window_secs = 7 * 86400
+    for window_ts in range(86400 * (first_ts // 86400), start_ts, window_secs):
+        window_end_ts = min(window_ts + window_secs, start_ts)
+        for rec in agg_store.query(window_ts, window_end_ts, defined="date_hr", fields=list(key_fields) + ["count", "sessions", "sessions_hll", "start_ts"]):
+            for tz in zones:
+                acc = accs.get((tz, rec["start_ts"] // 3600))
+                if acc is None:
+                    acc = LocalDayAccumulator(tz, rec["start_ts"])
+                    for hour_ts in range(acc.start_ts, acc.end_ts, 3600):
+                        accs[(tz, hour_ts // 3600)] = acc
+                acc.add_records([rec])
+        # write the local days which are complete, i.e. end in this window; the others are completed as their last hours are aggregated
+        done = {id(acc): acc for acc in accs.values() if acc.end_ts <= window_end_ts}
+        if len(done) > 0:
+            write_records(agg_store, [rec for acc in done.values() for rec in acc.records()])
+        accs = {k: acc for k, acc in accs.items() if id(acc) not in done}
+    write_records(agg_store, [], checkpoint=watermark_doc(start_ts - 3600, done_zones + zones))
 
-def aggregator():
-    ac = AnalyticsCore("basic-agg")
 
-    if ac.record_activity_container is None or ac.aggregated_container is None:
-        logging.info("Aborting aggregator(); activity aggregation is disabled.")
+def accumulate_hours(activity_store, start_ts, end_ts, page_size=1000):
+    # stream raw for the whole range as one (paged) query into per-hour accumulators. Rows are taken a page at a time so that the time
+    # waiting for the query and the time spent grouping can be told apart.
+    buckets = {hour_ts: HourAccumulator() for hour_ts in range(start_ts, end_ts, 3600)}
+    grouping_secs = 0.0
+    with stage("agg.raw_query", start=date_hr_of(start_ts), hours=len(buckets)) as query_stage:
+        rows = iter(activity_store.query(start_ts, end_ts, fields=raw_fields + ["_ts"]))
+        while True:
+            page = list(islice(rows, page_size))
+            if len(page) == 0:
+                break
+            t = time.perf_counter()
+            for row in page:
+                buckets[3600 * (row["_ts"] // 3600)].add(row)
+            grouping_secs += time.perf_counter() - t
+            query_stage.rows += len(page)
+        query_stage.exclude(grouping_secs)
+    metrics.record("agg.grouping", grouping_secs, rows=query_stage.rows)
+    return buckets
+
+
+def write_records(agg_store, recs, checkpoint=None):
+    with stage("agg.write") as st:
+        st.records = agg_store.write_many(recs, checkpoint=checkpoint)
+
+
+def delete_records(agg_store, items):
+    # Delete aggregate records, given (id, partition_key) pairs. In-memory copies of the agg container (see agg_cube.py) only see new and
+    # updated documents, so the ids are first added to the DELETED_ID document, which they read to drop the records too. The log keeps the
+    # latest deleted_log_size deletions, numbered by "seq", so that a copy which has missed some of those dropped from it can tell.
+    if len(items) == 0:
+        return
+    doc = agg_store.read_item(DELETED_ID)
+    seq = 0 if doc is None else doc["seq"]
+    deleted = ([] if doc is None else doc["deleted"]) + [[item_id, seq + 1 + i] for i, (item_id, _) in enumerate(items)]
+    write_records(agg_store, [{"id": DELETED_ID, "partition_key": "1", "seq": seq + len(items), "deleted": deleted[-deleted_log_size:]}])
+    for item_id, partition_key in items:
+        agg_store.delete_item(item_id, partition_key=partition_key)
+
+
+def complete_hour(agg_store, accs, hour_ts, recs, zones):
+    # Keep running totals for the day (and the local day in each time zone) and, if this is the day's last hour (i.e. "T23"), make the date
+    # records and their week and month rollups, and likewise the local day records. Hours must be completed in order. The accumulators are
+    # kept in accs, a dict by "date", "week", "month" or time zone, between calls. Returns the records made.
+    out = []
+    d_start_ts = 86400 * (hour_ts // 86400)
+    day_acc = accs.get("date")
+    if day_acc is None or day_acc.start_ts != d_start_ts:
+        day_acc = accs["date"] = DayAccumulator(d_start_ts)
+    day_acc.add_records(recs)
+    if hour_ts + 3600 == day_acc.end_ts:
+        with stage("agg.day_rollup", date=day_acc.period) as st:
+            day_acc.fill_missing(agg_store)
+            day_recs = day_acc.records()
+            out += day_recs + rollup_day(agg_store, accs, day_recs)
+            st.records = len(out)
+        del accs["date"]
+
+    for tz in zones:
+        acc = accs.get(tz)
+        if acc is None or not (acc.start_ts <= hour_ts < acc.end_ts):
+            acc = accs[tz] = LocalDayAccumulator(tz, hour_ts)
+        acc.add_records(recs)
+        if hour_ts + 3600 == acc.end_ts:
+            with stage("agg.local_day_rollup", tz=tz, date=acc.period) as st:
+                acc.fill_missing(agg_store)
+                local_recs = acc.records()
+                st.records = len(local_recs)
+            out += local_recs
+            del accs[tz]
+    return out
+
+
+def log_completed_dates(recs):
+    for d in sorted({rec["date"] for rec in recs if "date" in rec}):
+        logging.info(f"Completed date aggregation for {d}.")
+
+
+def aggregate_hours_parallel(activity_store, agg_store, index, start_ts, stop_ts, workers, zones):
+    # Opt-in ("agg_workers" > 1) for large catch-up runs: hours are independent, so each one is queried, aggregated and written by a
+    # thread pool worker. Results are completed in hour order in this thread, so date records are only made once all 24 of their hours are
+    # written, and the watermark only advances over a contiguous run of finished hours. Hours are only submitted up to 2 * workers hours
+    # ahead of the next hour to complete, so a slow hour holds up submission rather than letting finished hours pile up in memory.
+    # Each day's records are written as soon as its T23 hour completes, with the watermark. If a worker fails, the watermark stays at the last
+    # contiguous hour.
+    lock = threading.Lock()
+    run_stage = metrics.current()  # workers' stages are attributed to the run
+
+    def work(hour_ts):
+        with stage("agg.hour", parent=run_stage, hour=date_hr_of(hour_ts)):
+            recs = accumulate_hours(activity_store, hour_ts, hour_ts + 3600)[hour_ts].records(hour_ts)
+            with lock:
+                if index.add(recs):
+                    index.save()
+            write_records(agg_store, recs)
+        return recs
+
+    pending = {}
+    finished = {}
+    next_ts = start_ts  # the next hour to complete
+    submit_ts = start_ts  # the next hour to submit
+    accs = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while submit_ts < min(stop_ts, next_ts + 3600 * 2 * workers):
+                pending[pool.submit(work, submit_ts)] = submit_ts
+                submit_ts += 3600
+            if len(pending) == 0:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished[pending.pop(future)] = future.result()
+
+            # complete the contiguous run of finished hours; the watermark goes with any date records, or in a write of its own
+            last_ts = None
+            written_ts = None
+            while next_ts in finished:
+                day_recs = complete_hour(agg_store, accs, next_ts, finished.pop(next_ts), zones)
+                last_ts = next_ts
+                next_ts += 3600
+                if len(day_recs) > 0:
+                    write_records(agg_store, day_recs, checkpoint=watermark_doc(last_ts, zones))
+                    log_completed_dates(day_recs)
+                    written_ts = last_ts
+            if last_ts is not None and written_ts != last_ts:
+                write_records(agg_store, [], checkpoint=watermark_doc(last_ts, zones))
+    return (next_ts - start_ts) // 3600
+
+
+def aggregate_new_hours(activity_store, agg_store, config):
+    # find the latest aggregated hour from the watermark and compute the timestamp
+    with stage("agg.watermark"):
+        watermark = agg_store.read_item(WATERMARK_ID)
+        if watermark is not None:
+            start_ts = 3600 + watermark["watermark_ts"]  # timestamp for start of the first date-hour to aggregate for
+        else:
+            # recovery path (or a new container for agg data); find the latest date_hr for agg data
+            logging.info("No aggregation watermark found; scanning for the latest aggregated hour.")
+            max_agg_dh = agg_store.max_value("date_hr")
+            if max_agg_dh is None:
+                # catch case for new container for agg data; find the earliest date_hr in the raw activity log container
+                first_ts = activity_store.min_value("_ts")
+                if first_ts is None:
+                    logging.info("Aborting aggregator(); there is no activity to aggregate.")
+                    return
+                start_ts = 3600 * (first_ts // 3600)  # timestamp for start of the first date-hour to aggregate for
+            else:
+                start_ts = 3600 + ts_of_date_hr(max_agg_dh)  # timestamp for start of the first date-hour to aggregate for
+
+    # week and month records are rolled up from day records made before those tiers existed, once, and likewise local day records for
+    # newly configured time zones from hour records
+    zones = config.get("local_time_zones", [])
+    done_zones = [] if watermark is None else [tz for tz in watermark.get("zones", []) if tz in zones]
+    if watermark is None or watermark.get("tiers") != rollup_tiers:
+        backfill_rollups(agg_store, start_ts, done_zones)
+    new_zones = [tz for tz in zones if tz not in done_zones]
+    if len(new_zones) > 0 and agg_store.min_value("start_ts") is not None:
+        backfill_local_days(agg_store, new_zones, start_ts, done_zones)
+
+    # if the agg data is up to date, exit. This adds a small "safety margin"
+    now_ts = dt.now().timestamp()
+    if start_ts + 3600 + 60 >= now_ts:
+        logging.info("Aborting aggregator(); aggregated data is up to date.")
+        return
+
+    # the missing hour chunks to aggregate, up to the max configured number of missing hours for one call to aggregator()
+    n_hours = 0
+    while (start_ts + 3600 * (n_hours + 1) < now_ts) and (n_hours < config.get("max_agg_hours", 24)):
+        n_hours += 1
+    stop_ts = start_ts + 3600 * n_hours
+    window_secs = 3600 * max(1, config.get("backfill_window_hours", 24))
+
+    index = DistinctIndex(agg_store)
+    workers = config.get("agg_workers", 1)
+    if workers > 1:
+        n_updates = aggregate_hours_parallel(activity_store, agg_store, index, start_ts, stop_ts, workers, zones)
     else:
-        # find the latest date_hr for agg data and compute the timestamp
-        max_agg_dh = ac.aggregated_container.query_items("SELECT VALUE MAX(c.date_hr) FROM c", enable_cross_partition_query=True).next()
-        if max_agg_dh is None:
-            # catch case for new container for agg data; find the earliest date_hr in the raw activity log container
-            first_ts = ac.record_activity_container.query_items("SELECT VALUE MIN(c._ts) FROM c", enable_cross_partition_query=True).next()
-            start_ts = 3600 * (first_ts // 3600)  # timestamp for start of the first date-hour to aggregate for
+        n_updates = 0
+        accs = {}
+        for window_ts in range(start_ts, stop_ts, window_secs):
+            window_end_ts = min(window_ts + window_secs, stop_ts)
+            buckets = accumulate_hours(activity_store, window_ts, window_end_ts)
+            for hour_ts, acc in buckets.items():
+                recs = acc.records(hour_ts)
+                buckets[hour_ts] = None
+                day_recs = complete_hour(agg_store, accs, hour_ts, recs, zones)
+
+                # store aggregated, advancing the watermark only once the hour (and any date records) are written
+                if index.add(recs):
+                    index.save()
+                write_records(agg_store, recs + day_recs, checkpoint=watermark_doc(hour_ts, zones))
+                log_completed_dates(day_recs)
+                n_updates += 1
+
+    logging.info(f"Completed {n_updates} hour aggregations. Last covered timestamp = {stop_ts}.")
+
+
+def replace_records(agg_store, period_field, start_ts, recs, equals=None):
+    # Write the records for one period of a tier, and delete any other records of that period: records written with generated (uuid) ids
+    # before ids were deterministic, which upserting would leave alongside the new ones, and a nil activity record once there is activity.
+    ids = {rec["id"] for rec in recs}
+    existing = list(agg_store.query(start_ts, start_ts + 1, fields=["id", "partition_key"], equals=equals, defined=period_field))
+    write_records(agg_store, recs)
+    delete_records(agg_store, [(rec["id"], rec.get("partition_key", "1")) for rec in existing if rec["id"] not in ids])
+
+
+def reaggregate_hours(activity_store, agg_store, hours, zones=()):
+    # Re-aggregate hours which have already been aggregated, replacing their records, and then their day (and local day) records if the
+    # day is complete. Contiguous runs of hours are read with one raw query.
+    watermark_ts = agg_store.read_item(WATERMARK_ID)["watermark_ts"]
+    runs = []
+    for hour_ts in sorted(hours):
+        if runs and runs[-1][1] == hour_ts:
+            runs[-1][1] = hour_ts + 3600
         else:
-            start_ts = 3600 + int(dt.strptime(max_agg_dh, "%Y-%m-%dT%H").timestamp())  # timestamp for start of the first date-hour to aggregate for
+            runs.append([hour_ts, hour_ts + 3600])
+
+    days = set()
+    index = DistinctIndex(agg_store)
+    for run_start_ts, run_end_ts in runs:
+        for hour_ts, acc in accumulate_hours(activity_store, run_start_ts, run_end_ts).items():
+            recs = acc.records(hour_ts)
+            if index.add(recs):
+                index.save()
+            replace_records(agg_store, "date_hr", hour_ts, recs)
+            days.add(86400 * (hour_ts // 86400))
+
+    period_accs = {}
+    for d_start_ts in sorted(days):
+        # an incomplete day will get its date record when its T23 hour is aggregated
+        if d_start_ts + 23 * 3600 > watermark_ts:
+            continue
+        with stage("agg.day_rollup", date=date_hr_of(d_start_ts)[:10]):
+            day_acc = DayAccumulator(d_start_ts)
+            day_acc.fill_missing(agg_store)
+            day_recs = day_acc.records()
+        replace_records(agg_store, "date", d_start_ts, day_recs)
+        for period_field in rollup_tiers:
+            period = period_bounds(period_field, d_start_ts)[0]
+            acc = period_accs.get((period_field, period))
+            if acc is None:
+                acc = period_accs[(period_field, period)] = PeriodAccumulator(period_field, d_start_ts)
+            acc.add_records(day_recs)
+        logging.info(f"Re-aggregated date {day_acc.period}.")
+    # the weeks and months containing the re-aggregated days, with their other days read back with one query
+    if len(period_accs) > 0:
+        fill_periods(agg_store, period_accs.values(), max(acc.end_ts for acc in period_accs.values()))
+        for acc in period_accs.values():
+            replace_records(agg_store, acc.period_field, acc.start_ts, acc.records())
 
-        # if the agg data is up to date, exit. This adds a small "safety margin"
-        now_ts = dt.now().timestamp()
-        if start_ts + 3600 + 60 >= now_ts:
-            logging.info("Aborting aggregator(); aggregated data is up to date.")
+    local_days = {}
+    for hour_ts in hours:
+        for tz in zones:
+            acc = LocalDayAccumulator(tz, hour_ts)
+            local_days.setdefault((tz, acc.start_ts), acc)
+    for (tz, _), acc in sorted(local_days.items()):
+        if acc.end_ts - 3600 > watermark_ts:
+            continue
+        with stage("agg.local_day_rollup", tz=tz, date=acc.period):
+            acc.fill_missing(agg_store)
+            replace_records(agg_store, "local_date", acc.start_ts, acc.records(), equals={"tz": tz})
+
+
+def change_feed_aggregation(activity_store, agg_store, config):
+    # Incremental engine. Activity written since the last run is read from the change feed. The hours it falls in are dirty if they were
+    # already aggregated (i.e. it arrived late), and only those hours and their days are re-aggregated. New hours are aggregated as usual.
+    # The feed is read before new hours are aggregated, so activity for hours after the old watermark is left to aggregate_new_hours().
+    with stage("agg.watermark"):
+        watermark = agg_store.read_item(WATERMARK_ID)
+        feed_doc = agg_store.read_item(CHANGE_FEED_ID)
+    dirty = set()
+    n_changes = 0
+    with stage("agg.change_feed") as feed_stage:
+        feed = activity_store.read_changes(None if feed_doc is None else feed_doc["continuation"])
+        for row in feed:
+            n_changes += 1
+            hour_ts = 3600 * (row["_ts"] // 3600)
+            if watermark is not None and hour_ts <= watermark["watermark_ts"]:
+                dirty.add(hour_ts)
+        feed_stage.rows = n_changes
+
+    aggregate_new_hours(activity_store, agg_store, config)
+    if len(dirty) > 0:
+        reaggregate_hours(activity_store, agg_store, dirty, config.get("local_time_zones", []))
+    # only advance the continuation once the dirty hours have been re-aggregated
+    write_records(agg_store, [], checkpoint={"id": CHANGE_FEED_ID, "partition_key": "1", "continuation": feed.continuation})
+    logging.info(f"Read {n_changes} activity changes; re-aggregated {len(dirty)} hours with late activity.")
+
+
+def aggregator(activity_store=None, agg_store=None, config=None):
+    if activity_store is None or agg_store is None:
+        from pg_shared import AnalyticsCore  # only needed for the Cosmos containers, so the aggregation functions can be used without it
+        ac = AnalyticsCore("basic-agg")
+        if ac.record_activity_container is None or ac.aggregated_container is None:
+            logging.info("Aborting aggregator(); activity aggregation is disabled.")
             return
-        
-        # aggregate missing hour chunks, up to the max configured number of missing hours for one call to aggregator()
-        n_updates = 0
-        while (start_ts + 3600 < now_ts) and (n_updates < ac.activity_config.get("max_agg_hours", 24)):
-            end_ts = start_ts + 3600
-            # get raw
-            qry = "SELECT c.tag, c.plaything_name, c.plaything_part, c.specification_id, c.session_id,"\
-                  "SUBSTRING(TimestampToDateTime(c._ts * 1000), 0, 13) as date_hr FROM c "\
-                  f"WHERE c._ts >= {start_ts} AND c._ts < {end_ts}"
-            items = ac.record_activity_container.query_items(qry, enable_cross_partition_query=True)
-            df = pd.DataFrame(items).fillna("-")
-            if len(df) == 0:
-                # create a nil activity record
-                dh = dt.fromtimestamp(start_ts).strftime("%Y-%m-%dT%H")
-                rec = {"tag": "-", "plaything_name": "-", "plaything_part": "-", "specification_id": "-", "date_hr": dh, "count": 0, "sessions": 0, "start_ts": start_ts, "partition_key": "1"}
-                ac.aggregated_container.create_item(rec, enable_automatic_id_generation=True)
-            else:
-                # compute and store aggregated                
-                # there is no bulk API to CosmosDB (for Python SDK), so loop. NB there is actually an async client but I don't think it is warranted here
-                for ix, group in df.groupby(by=["tag", "plaything_name", "plaything_part", "specification_id"]):
-                    rec = group.iloc[0].drop(["session_id"]).to_dict()
-                    rec.update({"count": len(group), "sessions": group.session_id.nunique(), "start_ts": start_ts, "partition_key": "1"})  # force single partition
-                    ac.aggregated_container.create_item(rec, enable_automatic_id_generation=True)
-
-            # check for last hour and make a date record, re-querying the agg container
-            if rec["date_hr"].endswith("T23"):
-                d = rec["date_hr"][:10]
-                d_start_ts = start_ts - 23 * 3600
-                qry = f"SELECT c.tag, c.plaything_name, c.plaything_part, c.specification_id, c.count, c.sessions FROM c WHERE STARTSWITH(c.date_hr, '{d}')"
-                hours_df = pd.DataFrame(ac.aggregated_container.query_items(qry, enable_cross_partition_query=True))
-                # if the hours agg only contains "-" plaything entries, they are all "nil activity" records
-                pt_names = hours_df.plaything_name.unique()
-                if (len(pt_names) == 1) and (pt_names[0] == "-"):
-                    rec = {"tag": "-", "plaything_name": "-", "plaything_part": "-", "specification_id": "-", "date": d, "start_ts": d_start_ts, "count": 0, "sessions": 0, "partition_key": "1"}
-                    ac.aggregated_container.create_item(rec, enable_automatic_id_generation=True)
-                else:
-                    # zero-hour placeholders should be removed before creating day sums
-                    for ix, group in hours_df.loc[hours_df.plaything_name != "-"].groupby(by=["tag", "plaything_name", "plaything_part", "specification_id"]):
-                        rec = group.iloc[0][["tag", "plaything_name", "plaything_part", "specification_id"]].to_dict()
-                        rec.update(group[["count", "sessions"]].sum(axis=0).to_dict())
-                        rec.update({"date": d, "start_ts": d_start_ts, "partition_key": "1"})  # force single partition
-                        ac.aggregated_container.create_item(rec, enable_automatic_id_generation=True)
-                logging.info(f"Completed date aggregation for {d}.")
-
-            # prep for next iter
-            start_ts += 3600
-            n_updates += 1
-        logging.info(f"Completed {n_updates} hour aggregations. Last covered timestamp = {end_ts}.")
+        activity_store = CosmosStore(ac.record_activity_container, ts_field="_ts")
+        agg_store = CosmosStore(ac.aggregated_container, ts_field="start_ts")
+        config = ac.activity_config
+    config = config or {}
+
+    engine = config.get("agg_engine", "hourly")
+    with stage("agg.run", engine=engine):
+        if engine == "change_feed":
+            change_feed_aggregation(activity_store, agg_store, config)
+        else:
+            aggregate_new_hours(activity_store, agg_store, config)
+
 
 if __name__ == "__main__":
     aggregator()
@@ -0,0 +1,201 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from collections import Counter
+from datetime import datetime as dt, timezone
+from itertools import product
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agg_store import SQLiteStore
+from agg_cube import AggCube
+from agg_metrics import metrics as agg_metrics
+from agg_charts import series_figure
+from agg_series import SeriesCache
+from aggregator import aggregator
+from synthetic import generate_activity
+
+# Benchmark harness for the aggregator and the Basic view's chart callback, run against SQLiteStore stand-ins for the containers.
+# e.g. python bench/run_bench.py --hours 720 --rows-per-hour 2000 --compare bench/results/<earlier run>.json
+# - synthetic activity (see synthetic.py) is generated for the "--hours" hours ending at the last complete UTC hour
+# - the aggregator is run (as the timer would, but back to back) until it has caught up; reported as hours aggregated per second,
+#   along with the number of store queries and writes (a proxy for Cosmos round trips and RUs)
+# - the Basic view's chart callback, i.e. the memoised range query plus series_figure() (see agg_series.py), is then timed over
+#   combinations of date range, facet, plaything filter, filter_by/filter_value and metric, from a freshly loaded AggCube: once with the
+#   memo cleared (uncached) and then repeated (cached, as when other viewers ask for the same chart). The p50/p95 latency is reported
+#   overall, by range and by metric, along with the size of the figure JSON
+# Results are written as JSON (by default to bench/results/bench-<UTC time>.json) and, with --compare, shown against an earlier run.
+# The per-stage counters from agg_metrics are included in the results.
+# Peak RSS is for the whole process, including the synthetic data held by the SQLite stores; compare runs with the same arguments.
+
+range_days = (1, 7, 30, 90, 365)
+facets = (None, "tag", "specification_id")
+filter_bys = (None, "tag", "plaything_part")
+metrics = ("count", "sessions")
+
+
+class CountingStore:
+    # pass-through to an AggStore, counting calls by method name; writes also count records
+    def __init__(self, store):
+        self.store = store
+        self.calls = Counter()
+        self.records_written = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            result = attr(*args, **kwargs)
+            if name == "write_many":
+                self.records_written += result
+            return result
+        return counted
+
+    def stats(self):
+        return {"calls": dict(self.calls), "records_written": self.records_written}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux (bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def bench_aggregator(activity_store, agg_store, config, n_hours):
+    activity = CountingStore(activity_store)
+    agg = CountingStore(agg_store)
+    start = time.perf_counter()
+    runs = 0
+    while True:
+        last = agg_store.max_value("date_hr")
+        aggregator(activity, agg, config)
+        runs += 1
+        if agg_store.max_value("date_hr") == last:
+            break
+    elapsed = time.perf_counter() - start
+    return {"hours": n_hours, "runs": runs, "seconds": round(elapsed, 3), "hours_per_second": round(n_hours / elapsed, 2),
+            "activity_store": activity.stats(), "agg_store": agg.stats()}
+
+
+def latency(values):
+    return {"p50_ms": round(percentile(values, 50), 2), "p95_ms": round(percentile(values, 95), 2)}
+
+
+def bench_callback(agg_store, end_ts, repeat, top_n):
+    cube = AggCube(agg_store, ttl=3600)
+    series_cache = SeriesCache(agg_store, cube, ttl=3600)
+    start = time.perf_counter()
+    cube.refresh(force=True)
+    load_seconds = time.perf_counter() - start
+    playthings = cube.values("plaything_name")
+    filter_values = {filter_by: cube.values(filter_by)[0] for filter_by in filter_bys if filter_by is not None}  # one value of each
+    end_date = dt.fromtimestamp(end_ts, tz=timezone.utc).strftime("%Y-%m-%d")
+    uncached = []
+    cached = []
+    figure_bytes = []
+    by_range = {}
+    by_metric = {}
+    for days, facet, plaything_name, filter_by, metric in product(range_days, facets, (None, playthings[0]), filter_bys, metrics):
+        if filter_by is not None and filter_by == facet:
+            continue
+        start_date = dt.fromtimestamp(end_ts - 24 * 3600 * (days - 1), tz=timezone.utc).strftime("%Y-%m-%d")
+        query = (plaything_name, facet, filter_by, filter_values.get(filter_by), start_date, end_date, metric)
+        series_cache.cache_clear()
+        for i in range(1 + repeat):
+            start = time.perf_counter()
+            _, series = series_cache.range_query(*query, top_n=top_n, version=series_cache.data_version())
+            figure = series_figure(series)
+            elapsed = 1000 * (time.perf_counter() - start)
+            if i == 0:
+                uncached.append(elapsed)
+                figure_bytes.append(len(figure.to_json()))
+                by_range.setdefault(days, []).append(elapsed)
+                by_metric.setdefault(metric, []).append(elapsed)
+            else:
+                cached.append(elapsed)
+    return {"cube_records": len(cube), "cube_load_seconds": round(load_seconds, 3), "calls": len(uncached) + len(cached),
+            **latency(uncached), "cached": latency(cached),
+            "figure_bytes_p50": percentile(figure_bytes, 50), "figure_bytes_max": max(figure_bytes),
+            "by_range_days": {str(days): latency(v) for days, v in by_range.items()},
+            "by_metric": {metric: latency(v) for metric, v in by_metric.items()}}
+
+
+def compare(current, previous, path=""):
+    # print numeric values which differ between two results
+    for key, value in current.items():
+        name = f"{path}.{key}" if path else key
+        old = previous.get(key) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            compare(value, old, name)
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old != value:
+            change = f" ({(value - old) / old:+.1%})" if old != 0 else ""
+            print(f"{name}: {old} -> {value}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark aggregation and chart callbacks on synthetic activity.")
+    parser.add_argument("--hours", type=int, default=24 * 30)
+    parser.add_argument("--rows-per-hour", type=int, default=1000)
+    parser.add_argument("--playthings", type=int, default=10)
+    parser.add_argument("--parts", type=int, default=5)
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--specs", type=int, default=8)
+    parser.add_argument("--session-reuse", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--window-hours", type=int, default=24, help="backfill_window_hours config")
+    parser.add_argument("--workers", type=int, default=1, help="agg_workers config")
+    parser.add_argument("--repeat", type=int, default=3, help="cached timings per callback combination, after the uncached one")
+    parser.add_argument("--top-n", type=int, default=10, help="facet values shown before the rest are grouped as other (0 for all)")
+    parser.add_argument("--db", default=":memory:", help="SQLite path for the activity store")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare with")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    end_ts = 3600 * (int(time.time()) // 3600)  # the aggregator only aggregates complete hours
+    start_ts = end_ts - 3600 * args.hours
+    activity_store = SQLiteStore(args.db, ts_field="_ts")
+    agg_store = SQLiteStore(ts_field="start_ts")
+    start = time.perf_counter()
+    generated = generate_activity(activity_store, start_ts, args.hours, rows_per_hour=args.rows_per_hour,
+                                  n_playthings=args.playthings, n_parts=args.parts, n_tags=args.tags, n_specs=args.specs,
+                                  session_reuse=args.session_reuse, seed=args.seed)
+    generated["seconds"] = round(time.perf_counter() - start, 3)
+
+    config = {"max_agg_hours": args.hours, "backfill_window_hours": args.window_hours, "agg_workers": args.workers}
+    results = {
+        "run_at": dt.now(timezone.utc).isoformat(timespec="seconds"),
+        "args": vars(args),
+        "generated": generated,
+        "aggregator": bench_aggregator(activity_store, agg_store, config, args.hours),
+        "callback": bench_callback(agg_store, end_ts - 3600, args.repeat, args.top_n or None),
+    }
+    results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    results["stages"] = agg_metrics.snapshot()["stages"]  # per-stage timings, see agg_metrics.py
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         f"bench-{dt.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: results[k] for k in ("generated", "aggregator", "callback", "peak_rss_mb")}, indent=2))
+    print(f"Results written to {output}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
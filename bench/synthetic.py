@@ -0,0 +1,45 @@
+import random
+
+# Synthetic raw activity for benchmarks, written to a stand-in for the activity container (e.g. agg_store.SQLiteStore(ts_field="_ts")).
+# Rows look like those from activity recording: tag, plaything_name, plaything_part, specification_id, session_id and _ts.
+# - n_playthings, n_parts, n_tags and n_specs set the cardinality of each key field (parts and specifications are per plaything)
+# - session_reuse is the chance that a row belongs to an already-active session rather than starting a new one; sessions stay active
+#   for up to max_session_hours, so some span hours
+# - untagged is the proportion of rows with no tag (which the aggregator records as "-")
+# Values are skewed (Zipf-like), as real usage is, so that a few playthings and specifications get most of the activity.
+
+
+def _skewed_choice(rng, values):
+    return values[min(int(rng.paretovariate(1.2)) - 1, len(values) - 1)]
+
+
+def generate_activity(store, start_ts, hours, rows_per_hour=1000, n_playthings=10, n_parts=5, n_tags=20, n_specs=8,
+                      session_reuse=0.9, max_session_hours=2, untagged=0.05, seed=0):
+    rng = random.Random(seed)
+    playthings = [f"plaything-{i}" for i in range(n_playthings)]
+    parts = [f"part-{i}" for i in range(n_parts)]
+    tags = [f"tag-{i}" for i in range(n_tags)]
+    specs = [f"spec-{i}" for i in range(n_specs)]
+    active = []  # (session_id, plaything_name, specification_id, started_ts)
+    n_sessions = 0
+    n_rows = 0
+    for hour in range(hours):
+        hour_ts = start_ts + 3600 * hour
+        active = [s for s in active if s[3] > hour_ts - 3600 * max_session_hours]
+        rows = []
+        for offset in sorted(rng.randrange(3600) for _ in range(rows_per_hour)):
+            if len(active) > 0 and rng.random() < session_reuse:
+                session_id, plaything_name, specification_id, _ = rng.choice(active)
+            else:
+                n_sessions += 1
+                session_id = f"session-{n_sessions}"
+                plaything_name = _skewed_choice(rng, playthings)
+                specification_id = f"{plaything_name}-{_skewed_choice(rng, specs)}"
+                active.append((session_id, plaything_name, specification_id, hour_ts + offset))
+            row = {"_ts": hour_ts + offset, "plaything_name": plaything_name, "plaything_part": _skewed_choice(rng, parts),
+                   "specification_id": specification_id, "session_id": session_id}
+            if rng.random() >= untagged:
+                row["tag"] = _skewed_choice(rng, tags)
+            rows.append(row)
+        n_rows += store.write_many(rows)
+    return {"rows": n_rows, "sessions": n_sessions}
@@ -0,0 +1,121 @@
+import base64
+import math
+from hashlib import blake2b
+
+import numpy as np
+
+# A small HyperLogLog sketch of distinct session ids, stored with each aggregate record as "sessions_hll".
+# Sketches for different hours (or keys) merge by taking the register-wise maximum, so a day or any date range can report distinct
+# sessions without re-reading raw activity. Summing the hourly "sessions" over-counts sessions which span hours.
+# With P = 8 there are 256 one-byte registers and the standard error of the estimate is 1.04 / sqrt(256), i.e. about 6.5%
+# (so roughly +/-13% at 95% confidence). Below about 640 sessions the linear counting correction applies, which is a little more accurate
+# (about 5%).
+# Serialised as "d" + base64 of all registers (344 characters) or, when few registers are set, "s" + base64 of (index, value) pairs.
+# Where many sketches are merged at once (e.g. the dashboard's cube), they are decoded into the columns of an (M, n) uint8 array of
+# registers, and grouped_distinct_sessions() merges and estimates with numpy rather than one register at a time.
+
+P = 8
+M = 1 << P
+STANDARD_ERROR = 1.04 / math.sqrt(M)
+_alpha = 0.7213 / (1 + 1.079 / M)
+_w_bits = 64 - P
+_w_mask = (1 << _w_bits) - 1
+_inverse_powers = 2.0 ** -np.arange(256)  # 2 ** -r for each register value r
+
+
+class SessionSketch:
+    __slots__ = ("registers",)
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(M) if registers is None else bytearray(registers)
+
+    def add(self, value):
+        h = int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        ix = h >> _w_bits
+        rank = _w_bits - (h & _w_mask).bit_length() + 1
+        if rank > self.registers[ix]:
+            self.registers[ix] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        self.registers = bytearray(np.maximum(np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8)))
+        return self
+
+    def estimate(self):
+        return float(estimates(np.frombuffer(self.registers, dtype=np.uint8)[np.newaxis])[0])
+
+    def to_string(self):
+        set_ix = [ix for ix, r in enumerate(self.registers) if r > 0]
+        if 2 * len(set_ix) < M:
+            pairs = bytearray()
+            for ix in set_ix:
+                pairs += bytes((ix, self.registers[ix]))
+            return "s" + base64.b64encode(pairs).decode()
+        return "d" + base64.b64encode(self.registers).decode()
+
+    @classmethod
+    def from_string(cls, s):
+        raw = base64.b64decode(s[1:])
+        if s[0] == "d":
+            return cls(raw)
+        sketch = cls()
+        for i in range(0, len(raw), 2):
+            sketch.registers[raw[i]] = raw[i + 1]
+        return sketch
+
+
+def estimates(registers):
+    # the estimate for each row of an (n, M) array of registers
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    e = _alpha * M * M / _inverse_powers[registers].sum(axis=1)
+    small = (e <= 2.5 * M) & (zeros > 0)
+    e[small] = M * np.log(M / zeros[small])  # linear counting for small cardinalities
+    return e
+
+
+def registers_of(sketch_string):
+    # the registers of a serialised sketch as a uint8 array, or None if there is no sketch
+    if not isinstance(sketch_string, str):
+        return None
+    return np.frombuffer(SessionSketch.from_string(sketch_string).registers, dtype=np.uint8)
+
+
+def merge_sketches(sketch_strings):
+    # merged SessionSketch, or None if any of the records lacks a sketch (e.g. records aggregated before sketches were stored)
+    merged = SessionSketch()
+    for s in sketch_strings:
+        if not isinstance(s, str):
+            return None
+        merged.merge(SessionSketch.from_string(s))
+    return merged
+
+
+def bounded_estimate(sketch, max_sessions, sum_sessions):
+    # The largest single "sessions" value and the sum of them are exact bounds on the distinct sessions, so clamp the estimate.
+    # Falls back to the sum if there is no sketch.
+    if sketch is None:
+        return sum_sessions
+    return min(max(round(sketch.estimate()), max_sessions), sum_sessions)
+
+
+def distinct_sessions(sessions, sketch_strings):
+    # distinct sessions over several records, from their "sessions" and "sessions_hll" values
+    sessions = [int(s) for s in sessions]
+    if len(sessions) == 0:
+        return 0
+    return bounded_estimate(merge_sketches(sketch_strings), max(sessions), sum(sessions))
+
+
+def grouped_distinct_sessions(sessions, registers, has_sketch, starts):
+    # distinct_sessions() for each group of consecutive records, where starts holds the first index of each (non-empty) group, as for
+    # np.add.reduceat. registers is an (M, n) uint8 array with a column for each record's sketch (register-major, so that the reduction
+    # runs over contiguous memory), and has_sketch is False for records without one.
+    sum_sessions = np.add.reduceat(sessions, starts)
+    max_sessions = np.maximum.reduceat(sessions, starts)
+    e = np.rint(estimates(np.maximum.reduceat(registers, starts, axis=1).T))
+    bounded = np.minimum(np.maximum(e, max_sessions), sum_sessions)
+    return np.where(np.logical_and.reduceat(has_sketch, starts), bounded, sum_sessions).astype(np.int64)
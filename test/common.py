@@ -0,0 +1,78 @@
+import json
+import random
+import time
+from collections import Counter
+
+import aggregator
+from agg_store import SQLiteStore
+
+# Shared helpers for the tests: synthetic raw activity, aggregation runs on SQLiteStore stand-ins, and record comparison.
+
+tags = ["tag-a", "tag-b", "tag-c"]
+playthings = ["pt-1", "pt-2"]
+parts = ["part-x", "part-y"]
+specs = ["spec-1", "spec-2", "spec-3"]
+
+
+class CountingStore(SQLiteStore):
+    # a SQLiteStore which counts queries, by the field they require to be defined (None for raw activity), and records deleted ids
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = Counter()
+        self.deleted = []
+
+    def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+        self.queries[defined] += 1
+        return super().query(start_ts, end_ts, fields=fields, equals=equals, defined=defined)
+
+    def delete_item(self, item_id, partition_key="1"):
+        self.deleted.append(item_id)
+        return super().delete_item(item_id, partition_key=partition_key)
+
+
+def random_rows(start_ts, end_ts, n, seed=0, skip_hours=()):
+    # n rows with _ts in [start_ts, end_ts), none in the hours (offsets from start_ts) in skip_hours, and some missing a tag
+    rng = random.Random(seed)
+    rows = []
+    while len(rows) < n:
+        ts = rng.randrange(start_ts, end_ts)
+        if (ts - start_ts) // 3600 in skip_hours:
+            continue
+        row = {"_ts": ts, "tag": rng.choice(tags), "plaything_name": rng.choice(playthings), "plaything_part": rng.choice(parts),
+               "specification_id": rng.choice(specs), "session_id": f"session-{rng.randrange(200)}"}
+        if rng.random() < 0.05:
+            del row["tag"]
+        rows.append(row)
+    return rows
+
+
+def recent_hours(n_hours, margin_hours=2):
+    # start of a range of n_hours complete hours, ending margin_hours before the current hour
+    return 3600 * (int(time.time()) // 3600 - margin_hours - n_hours)
+
+
+def activity_store(rows, store_class=SQLiteStore):
+    store = store_class(ts_field="_ts")
+    store.write_many(rows)
+    return store
+
+
+def aggregate(activity, n_hours, **config):
+    # aggregate exactly n_hours from the first activity (so repeated runs agree even if the clock moves on to another hour)
+    agg = SQLiteStore()
+    aggregator.aggregator(activity, agg, dict({"max_agg_hours": n_hours}, **config))
+    return agg
+
+
+def records(agg, defined=None):
+    # all aggregate records, without the system timestamp, in a canonical order
+    docs = [{k: v for k, v in doc.items() if k != "_ts"} for doc in agg.query(0, 2 ** 40, defined=defined)]
+    return sorted(docs, key=lambda doc: json.dumps(doc, sort_keys=True))
+
+
+def make_legacy(agg, start_ts, end_ts, period_field):
+    # rewrite the records of a tier with start_ts in [start_ts, end_ts) as if written before ids were deterministic, i.e. with generated ids
+    docs = list(agg.query(start_ts, end_ts, defined=period_field))
+    for doc in docs:
+        agg.delete_item(doc["id"])
+    agg.write_many([{k: v for k, v in doc.items() if k not in ("id", "_ts")} for doc in docs])
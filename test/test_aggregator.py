@@ -0,0 +1,69 @@
+import time
+
+import aggregator
+from agg_store import SQLiteStore
+from test.common import random_rows, recent_hours, activity_store, aggregate, records, make_legacy
+
+n_hours = 72
+
+
+class SlowHourStore(SQLiteStore):
+    # an activity store whose raw query for one hour is slow, so that parallel workers finish later hours first
+    slow_ts = None
+
+    def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+        if start_ts == self.slow_ts:
+            time.sleep(1)
+        return super().query(start_ts, end_ts, fields=fields, equals=equals, defined=defined)
+
+
+def test_parallel_with_a_delayed_hour_matches_serial():
+    n_days = 4
+    start_ts = 86400 * (recent_hours(24 * n_days) // 86400 - 1)  # whole days, so that several T23 hours complete in one run
+    n = (recent_hours(0) - start_ts) // 3600
+    rows = random_rows(start_ts, start_ts + 3600 * n, 4000)
+    expected = records(aggregate(activity_store(rows), n))
+
+    activity = activity_store(rows, SlowHourStore)
+    activity.slow_ts = start_ts + 3 * 3600
+    assert records(aggregate(activity, n, agg_workers=4)) == expected
+
+
+def test_reaggregation_replaces_records_with_generated_ids():
+    # hour and day records written before ids were deterministic have generated ids, which must not survive re-aggregation
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 2000)
+    late = [dict(rows[0], _ts=start_ts + 5 * 3600 + 10)]
+    late_day_ts = 86400 * ((start_ts + 5 * 3600) // 86400)
+    activity = activity_store(rows)
+    agg = aggregate(activity, n_hours, agg_engine="change_feed")
+    make_legacy(agg, start_ts + 5 * 3600, start_ts + 6 * 3600, "date_hr")
+    make_legacy(agg, late_day_ts, late_day_ts + 1, "date")
+
+    activity.write_many(late)
+    aggregator.aggregator(activity, agg, {"agg_engine": "change_feed", "max_agg_hours": 0})
+    assert records(agg) == records(aggregate(activity_store(rows + late), n_hours))
+
+
+def test_late_row_reaggregates_hour_day_week_and_local_day():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 2000)
+    # late activity for an already aggregated hour, in an existing key and in a key which is new for the hour
+    late = [dict(rows[0], _ts=start_ts + 5 * 3600 + 10), dict(rows[1], _ts=start_ts + 5 * 3600 + 20, tag="tag-late")]
+    config = {"agg_engine": "change_feed", "local_time_zones": ["Europe/London"]}
+
+    activity = activity_store(rows)
+    agg = SQLiteStore()
+    aggregator.aggregator(activity, agg, dict(config, max_agg_hours=n_hours))
+    before = records(agg)
+    activity.write_many(late)
+    aggregator.aggregator(activity, agg, dict(config, max_agg_hours=0))  # only the change feed; no new hours
+    after = records(agg)
+
+    # the same as if the late rows had been there all along
+    assert after == records(aggregate(activity_store(rows + late), n_hours, local_time_zones=config["local_time_zones"]))
+    for period_field in ("date_hr", "date", "week", "month", "local_date"):
+        total_before = sum(rec["count"] for rec in before if period_field in rec and rec["start_ts"] <= start_ts + 5 * 3600)
+        total_after = sum(rec["count"] for rec in after if period_field in rec and rec["start_ts"] <= start_ts + 5 * 3600)
+        assert total_after == total_before + 2, period_field
+    assert any(rec["tag"] == "tag-late" for rec in after if "local_date" in rec)
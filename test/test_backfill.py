@@ -0,0 +1,22 @@
+from test.common import CountingStore, random_rows, recent_hours, activity_store, aggregate, records
+
+n_hours = 72
+
+
+def test_window_sizes_give_identical_records():
+    start_ts = recent_hours(n_hours)
+    activity = activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 3000, skip_hours=range(10, 14)))
+    results = [records(aggregate(activity, n_hours, backfill_window_hours=window)) for window in (1, 5, 24)]
+    assert results[0] == results[1] == results[2]
+    assert sum(rec["count"] for rec in results[0] if "date_hr" in rec) == 3000
+    # hours without activity have a nil activity record
+    assert sum(1 for rec in results[0] if "date_hr" in rec and rec["count"] == 0) == 4
+
+
+def test_one_raw_query_per_window():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 1000)
+    for window, n_queries in ((24, 3), (5, 15), (72, 1)):
+        activity = activity_store(rows, CountingStore)
+        aggregate(activity, n_hours, backfill_window_hours=window)
+        assert activity.queries[None] == n_queries
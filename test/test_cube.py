@@ -0,0 +1,147 @@
+import numpy as np
+
+import aggregator
+from agg_charts import series_figure, other_label
+from agg_cube import AggCube
+from agg_store import DELETED_ID
+from session_sketch import distinct_sessions
+from test.common import random_rows, recent_hours, activity_store, aggregate, make_legacy
+
+n_hours = 48
+
+
+def store_totals(agg, period_field):
+    totals = {}
+    for rec in agg.query(0, 2 ** 40, defined=period_field):
+        totals[rec[period_field]] = totals.get(rec[period_field], 0) + rec["count"]
+    return totals
+
+
+def cube_totals(cube, period_field, start_ts, end_ts):
+    df = cube.series(period_field, start_ts, end_ts, "count")
+    return dict(zip(df[period_field], df["count"]))
+
+
+def test_refresh_drops_records_deleted_by_reaggregation():
+    start_ts = recent_hours(n_hours)
+    end_ts = start_ts + 3600 * n_hours
+    rows = random_rows(start_ts, end_ts, 2000)
+    activity = activity_store(rows)
+    agg = aggregate(activity, n_hours, agg_engine="change_feed")
+    make_legacy(agg, start_ts + 5 * 3600, start_ts + 6 * 3600, "date_hr")
+    cube = AggCube(agg)
+    cube.refresh(force=True)
+
+    # re-aggregating the hour replaces its records with generated ids, which the cube must drop rather than keep alongside the new ones
+    activity.write_many([dict(rows[0], _ts=start_ts + 5 * 3600 + 10)])
+    aggregator.aggregator(activity, agg, {"agg_engine": "change_feed", "max_agg_hours": 0})
+    assert agg.read_item(DELETED_ID)["seq"] > 0
+    cube.refresh(force=True)
+    assert cube_totals(cube, "date_hr", start_ts, end_ts) == store_totals(agg, "date_hr")
+    assert cube_totals(cube, "date", 0, 2 ** 40) == store_totals(agg, "date")
+    assert len(cube) == sum(1 for _ in agg.query(0, 2 ** 40))
+
+
+def test_reload_when_deletions_were_dropped_from_the_log(monkeypatch):
+    monkeypatch.setattr(aggregator, "deleted_log_size", 2)
+    start_ts = recent_hours(n_hours)
+    end_ts = start_ts + 3600 * n_hours
+    rows = random_rows(start_ts, end_ts, 2000)
+    activity = activity_store(rows)
+    agg = aggregate(activity, n_hours, agg_engine="change_feed")
+    make_legacy(agg, start_ts + 5 * 3600, start_ts + 7 * 3600, "date_hr")
+    cube = AggCube(agg)
+    cube.refresh(force=True)
+
+    for hour in (5, 6):
+        activity.write_many([dict(rows[0], _ts=start_ts + hour * 3600 + 10)])
+        aggregator.aggregator(activity, agg, {"agg_engine": "change_feed", "max_agg_hours": 0})
+    deleted = agg.read_item(DELETED_ID)
+    assert deleted["seq"] > 2 and len(deleted["deleted"]) == 2
+    cube.refresh(force=True)
+    assert cube_totals(cube, "date_hr", start_ts, end_ts) == store_totals(agg, "date_hr")
+    assert len(cube) == sum(1 for _ in agg.query(0, 2 ** 40))
+
+
+def test_sessions_match_merging_the_stored_sketches():
+    start_ts = recent_hours(n_hours)
+    end_ts = start_ts + 3600 * n_hours
+    agg = aggregate(activity_store(random_rows(start_ts, end_ts, 3000)), n_hours)
+    # records aggregated before sketches were stored have none, and their sessions are summed
+    legacy = [{k: v for k, v in doc.items() if k not in ("sessions_hll", "_ts")} for doc in agg.query(start_ts, start_ts + 3600, defined="date_hr")]
+    agg.write_many(legacy)
+    cube = AggCube(agg)
+
+    for period_field, facet in (("date_hr", "tag"), ("date_hr", None), ("date", "specification_id")):
+        groups = {}
+        for rec in agg.query(start_ts, end_ts, defined=period_field):
+            groups.setdefault((rec[period_field], rec[facet] if facet else None), []).append(rec)
+        df = cube.series(period_field, start_ts, end_ts, "sessions", facet=facet)
+        got = {(period, value if facet else None): sessions
+               for period, value, sessions in zip(df[period_field], df[facet] if facet else df[period_field], df["sessions"])}
+        assert got == {k: distinct_sessions([rec["sessions"] for rec in recs], [rec.get("sessions_hll") for rec in recs])
+                       for k, recs in groups.items()}
+    recs = list(agg.query(start_ts, end_ts, defined="date_hr", equals={"tag": "tag-a"}))
+    assert cube.range_sessions("date_hr", start_ts, end_ts, equals={"tag": "tag-a"}) == \
+        distinct_sessions([rec["sessions"] for rec in recs], [rec.get("sessions_hll") for rec in recs])
+    assert cube.range_sessions("date_hr", start_ts, end_ts, equals={"tag": "no-such-tag"}) == 0
+
+
+def test_top_n_and_other_totals():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 2000)
+    # distinct totals, so the top 5 are well defined: spec-k has k + 1 rows, and spec-big the rest
+    specs = [f"spec-{k}" for k in range(17) for _ in range(k + 1)]
+    for i, row in enumerate(rows):
+        row["specification_id"] = specs[i] if i < len(specs) else "spec-big"
+    cube = AggCube(aggregate(activity_store(rows), n_hours))
+    end_ts = start_ts + 3600 * n_hours
+
+    full = cube.series("date_hr", start_ts, end_ts, "count", facet="specification_id")
+    top = cube.series("date_hr", start_ts, end_ts, "count", facet="specification_id", top_n=5)
+    totals = full.groupby("specification_id")["count"].sum().sort_values(ascending=False, kind="stable")
+    kept = set(totals.index[:5])
+    assert set(top["specification_id"].dropna()) == kept and top["specification_id"].isna().any()
+    # per period, the kept values are unchanged and other (a null facet value) is the sum of the rest
+    for dh, group in full.groupby("date_hr"):
+        top_group = top[top["date_hr"] == dh]
+        assert top_group["count"].sum() == group["count"].sum()
+        kept_counts = top_group.dropna().set_index("specification_id")["count"]
+        for spec, count in zip(group["specification_id"], group["count"]):
+            if spec in kept:
+                assert kept_counts[spec] == count
+        assert top_group[top_group["specification_id"].isna()]["count"].sum() == group[~group["specification_id"].isin(kept)]["count"].sum()
+
+    # other sessions are distinct sessions over the collapsed values, so no more than their sum
+    sessions = cube.series("date_hr", start_ts, end_ts, "sessions", facet="specification_id", top_n=5)
+    all_sessions = cube.series("date_hr", start_ts, end_ts, "sessions", facet="specification_id")
+    for dh, group in sessions[sessions["specification_id"].isna()].groupby("date_hr"):
+        rest = all_sessions[(all_sessions["date_hr"] == dh) & ~all_sessions["specification_id"].isin(kept)]
+        assert group["sessions"].sum() <= rest["sessions"].sum()
+
+
+def test_figure_has_one_trace_per_kept_value():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 1000)
+    cube = AggCube(aggregate(activity_store(rows), n_hours))
+    df = cube.series("date_hr", start_ts, start_ts + 3600 * n_hours, "count", facet="tag", top_n=2)
+    figure = series_figure({"period": "date_hr", "facet": "tag", "metric": "count", "df": df})
+    assert [trace.name for trace in figure.data][-1] == other_label
+    assert len(figure.data) == 3
+    assert sum(int(np.sum(trace.y)) for trace in figure.data) == 1000
+    assert figure.layout.barmode == "relative"
+
+
+def test_a_facet_value_named_other_is_not_merged_with_the_collapsed_values():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 1000)
+    # "other" is the most frequent tag, so it is kept, and t0..t6 are collapsed
+    for i, row in enumerate(rows):
+        row["tag"] = "other" if i % 2 == 0 else f"t{i % 7}"
+    cube = AggCube(aggregate(activity_store(rows), n_hours))
+    df = cube.series("date_hr", start_ts, start_ts + 3600 * n_hours, "count", facet="tag", top_n=2)
+    assert (df["tag"] == "other").sum() > 0 and df["tag"].isna().sum() > 0
+    figure = series_figure({"period": "date_hr", "facet": "tag", "metric": "count", "df": df})
+    names = [trace.name for trace in figure.data]
+    assert len(names) == 3 and names[0] == "other" and names[-1] == other_label  # the tag "other" has the largest total
+    assert sum(int(np.sum(trace.y)) for trace in figure.data) == 1000
@@ -0,0 +1,48 @@
+import aggregator
+from agg_store import DISTINCT_INDEX_ID
+from test.common import random_rows, recent_hours, activity_store, aggregate
+
+n_hours = 48
+
+
+def scanned(agg):
+    # the distinct values as found by SELECT DISTINCT VALUE over the records, in the index document's form
+    fields = {f: sorted(agg.distinct_values(f)) for f in aggregator.key_fields}
+    return {"fields": fields,
+            "by_plaything": {pn: {f: sorted(agg.distinct_values(f, equals={"plaything_name": pn})) for f in aggregator.key_fields if f != "plaything_name"}
+                             for pn in fields["plaything_name"]}}
+
+
+def index_doc(agg):
+    doc = agg.read_item(DISTINCT_INDEX_ID)
+    return {"fields": doc["fields"], "by_plaything": doc["by_plaything"]}
+
+
+def test_index_matches_a_scan_and_is_updated_by_late_activity():
+    start_ts = recent_hours(n_hours)
+    rows = random_rows(start_ts, start_ts + 3600 * n_hours, 1000, skip_hours=[3])
+    activity = activity_store(rows)
+    agg = aggregate(activity, n_hours, agg_engine="change_feed")
+    assert index_doc(agg) == scanned(agg)
+    assert "-" in index_doc(agg)["fields"]["plaything_name"]  # from the nil activity record of the empty hour
+
+    activity.write_many([dict(rows[0], _ts=start_ts + 5 * 3600, tag="tag-late", plaything_part="part-late")])
+    aggregator.aggregator(activity, agg, {"agg_engine": "change_feed", "max_agg_hours": 0})
+    doc = index_doc(agg)
+    assert doc == scanned(agg)
+    assert "tag-late" in doc["fields"]["tag"] and "part-late" in doc["by_plaything"][rows[0]["plaything_name"]]["plaything_part"]
+
+
+def test_missing_index_is_rebuilt_from_the_records():
+    start_ts = recent_hours(n_hours)
+    agg = aggregate(activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 1000)), n_hours)
+    expected = index_doc(agg)
+    assert agg.delete_item(DISTINCT_INDEX_ID)
+    index = aggregator.DistinctIndex(agg)
+    index.save()
+    assert index_doc(agg) == expected
+
+    rec = {"tag": "tag-a", "plaything_name": "pt-1", "plaything_part": "part-x", "specification_id": "spec-1"}
+    assert not index.add([rec])
+    assert index.add([dict(rec, specification_id="spec-new")])
+    assert "spec-new" in index.by_plaything["pt-1"]["specification_id"] and "spec-new" not in index.by_plaything["pt-2"]["specification_id"]
@@ -0,0 +1,32 @@
+import pandas as pd
+
+import aggregator
+from agg_time import date_hr_of
+from session_sketch import SessionSketch
+from test.common import random_rows, recent_hours
+
+
+def test_hour_records_match_pandas_groupby():
+    start_ts = recent_hours(1)
+    rows = random_rows(start_ts, start_ts + 3600, 500)
+    acc = aggregator.HourAccumulator()
+    for row in rows:
+        acc.add(row)
+    recs = acc.records(start_ts)
+
+    # as the aggregator did before the streaming accumulator
+    expected = []
+    df = pd.DataFrame(rows).fillna("-")
+    for ix, group in df.groupby(by=["tag", "plaything_name", "plaything_part", "specification_id"]):
+        expected.append(dict(zip(aggregator.key_fields, ix), count=len(group), sessions=group.session_id.nunique()))
+    assert [{f: rec[f] for f in list(aggregator.key_fields) + ["count", "sessions"]} for rec in recs] == expected
+    assert all(rec["date_hr"] == date_hr_of(start_ts) and rec["start_ts"] == start_ts for rec in recs)
+    assert SessionSketch.from_string(recs[0]["sessions_hll"]).estimate() > 0
+
+
+def test_empty_hour_has_nil_record():
+    start_ts = recent_hours(1)
+    recs = aggregator.HourAccumulator().records(start_ts)
+    assert len(recs) == 1
+    assert [recs[0][f] for f in aggregator.key_fields] == list(aggregator.nil_key)
+    assert recs[0]["count"] == 0
@@ -0,0 +1,67 @@
+from datetime import date, datetime as dt, timezone
+from zoneinfo import ZoneInfo
+
+import aggregator
+from agg_time import local_day_start
+from agg_store import SQLiteStore
+from test.common import random_rows, recent_hours, activity_store, aggregate, records
+
+
+def ts(*args):
+    return int(dt(*args, tzinfo=timezone.utc).timestamp())
+
+
+def local_day_records(tz, start_ts, end_ts):
+    # local day records made by complete_hour() for hours [start_ts, end_ts), each with one row of activity
+    agg = SQLiteStore()
+    accs = {}
+    out = []
+    for hour_ts in range(start_ts, end_ts, 3600):
+        acc = aggregator.HourAccumulator()
+        acc.add({"tag": "t", "plaything_name": "p", "plaything_part": "x", "specification_id": "s", "session_id": str(hour_ts)})
+        recs = acc.records(hour_ts)
+        agg.write_many(recs)
+        out += [rec for rec in aggregator.complete_hour(agg, accs, hour_ts, recs, [tz]) if "local_date" in rec]
+    return {rec["local_date"]: rec for rec in out}
+
+
+def test_23_and_25_hour_days():
+    london = ZoneInfo("Europe/London")
+    for local_date, hours in ((date(2026, 3, 29), 23), (date(2025, 10, 26), 25), (date(2026, 3, 30), 24)):
+        start_ts = local_day_start(london, local_date)
+        assert dt.fromtimestamp(start_ts, tz=london).strftime("%Y-%m-%d %H:%M") == f"{local_date} 00:00"
+        recs = local_day_records("Europe/London", start_ts - 6 * 3600, start_ts + 30 * 3600)
+        rec = recs[local_date.isoformat()]
+        assert (rec["tz"], rec["start_ts"], rec["count"]) == ("Europe/London", start_ts, hours)
+        assert rec["sessions"] == hours
+
+
+def test_half_hour_offset_zone():
+    # India is +05:30; the hour starting 00:30 local is the first of the local day
+    kolkata = ZoneInfo("Asia/Kolkata")
+    start_ts = local_day_start(kolkata, date(2026, 3, 29))
+    assert start_ts == ts(2026, 3, 28, 19)
+    recs = local_day_records("Asia/Kolkata", ts(2026, 3, 28, 12), ts(2026, 3, 30, 0))
+    assert recs["2026-03-29"]["count"] == 24
+    assert recs["2026-03-29"]["start_ts"] == start_ts
+
+
+def test_local_days_are_not_date_records():
+    recs = local_day_records("America/New_York", ts(2026, 3, 7), ts(2026, 3, 10))
+    assert recs["2026-03-08"]["count"] == 23  # US daylight saving time starts
+    assert all("date" not in rec for rec in recs.values())
+    assert len({rec["id"] for rec in recs.values()}) == len(recs)
+
+
+def test_zone_added_later_is_backfilled_like_a_fresh_run():
+    n_hours = 24 * 9
+    start_ts = recent_hours(n_hours)
+    activity = activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 3000))
+    zones = ["Europe/London", "Asia/Kolkata"]
+    fresh = aggregate(activity, n_hours, local_time_zones=zones)
+
+    # aggregate some days without the zones, then add them; the days before are rolled up from the stored hour records
+    agg = aggregate(activity, 24 * 5 + 7)
+    aggregator.aggregator(activity, agg, {"max_agg_hours": n_hours - (24 * 5 + 7), "local_time_zones": zones})
+    assert len(records(fresh, "local_date")) > 0
+    assert records(agg, "local_date") == records(fresh, "local_date")
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+import agg_metrics
+from agg_metrics import Metrics
+
+
+def test_stages_nest_and_charges_reach_every_enclosing_stage():
+    m = Metrics()
+    with m.stage("run", hour=3) as run:
+        with m.stage("query") as query:
+            query.rows = 10
+            m.add_charge(2.5)
+            with m.stage("page"):
+                m.add_charge(1.0)
+        with m.stage("write") as write:
+            write.records = 4
+            m.add_charge(0.5)
+    assert m.current() is None
+    assert (run.ru, query.ru, write.ru) == (4.0, 3.5, 0.5)
+    # the breakdown of the outermost stage has every sub-stage, at any depth, including its own sub-stages
+    assert {name: (calls, ru) for name, (calls, secs, ru) in run.breakdown.items()} == {"query": (1, 3.5), "page": (1, 1.0), "write": (1, 0.5)}
+    assert list(query.breakdown) == ["page"]
+    counters = m.snapshot()["stages"]
+    assert (counters["query"]["rows"], counters["write"]["records"], counters["run"]["ru"]) == (10, 4, 4.0)
+    assert counters["run"]["seconds"] >= counters["query"]["seconds"] + counters["write"]["seconds"]
+
+
+def test_excluded_time_and_errors():
+    m = Metrics()
+    with m.stage("query") as st:
+        time.sleep(0.05)
+        st.exclude(0.05)  # e.g. grouping rows between pages, recorded separately
+    assert m.counters["query"]["seconds"] < 0.04
+    with pytest.raises(KeyError):
+        with m.stage("fails"):
+            raise KeyError("x")
+    with m.stage("fails"):
+        pass
+    assert (m.counters["fails"]["calls"], m.counters["fails"]["errors"]) == (2, 1)
+    assert m.current() is None
+
+
+def test_snapshot_percentiles():
+    m = Metrics()
+    for ms in range(1, 101):
+        m.record("callback", ms / 1000)
+    c = m.snapshot()["stages"]["callback"]
+    assert (c["calls"], c["p50_ms"], c["p95_ms"], c["max_seconds"]) == (100, 51.0, 96.0, 0.1)
+
+
+def test_timed_runs_the_function_as_a_stage():
+    m = Metrics()
+
+    @m.timed("view.callback")
+    def callback(x):
+        m.add_charge(x)
+        return x + 1
+
+    assert callback(2) == 3 and callback.__name__ == "callback"
+    assert (m.counters["view.callback"]["calls"], m.counters["view.callback"]["ru"]) == (1, 2.0)
+
+
+def test_cosmos_charge_goes_to_the_current_stage():
+    with agg_metrics.stage("test.cosmos") as st:
+        agg_metrics.cosmos_charge({"x-ms-request-charge": "2.83"})
+        agg_metrics.cosmos_charge({})
+        agg_metrics.cosmos_charge(None)
+    assert st.ru == pytest.approx(2.83)
+
+
+def test_work_in_other_threads_is_attributed_by_an_explicit_parent():
+    m = Metrics()
+    with m.stage("run") as run:
+        def work(i):
+            with m.stage("worker", parent=run):
+                m.add_charge(1.0)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert run.ru == 4.0
+    assert run.breakdown["worker"][0] == 4
@@ -0,0 +1,81 @@
+from datetime import datetime as dt, timezone
+
+import aggregator
+from agg_charts import choose_period
+from agg_time import period_bounds
+from test.common import CountingStore, random_rows, recent_hours, activity_store, aggregate, records
+
+n_hours = 24 * 10
+
+
+def ts(*args):
+    return int(dt(*args, tzinfo=timezone.utc).timestamp())
+
+
+def test_choose_period_gives_enough_bars():
+    start = dt(2026, 1, 1)
+    for days, period_name in ((0, "date_hr"), (4, "date_hr"), (5, "date"), (34, "date"), (35, "week"), (152, "week"), (153, "month"),
+                              (365, "month")):
+        assert choose_period(start, start.replace(year=2027) if days == 365 else dt.fromordinal(start.toordinal() + days)) == period_name
+
+
+def test_week_and_month_records_sum_the_days():
+    start_ts = recent_hours(n_hours)
+    agg = aggregate(activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 5000)), n_hours)
+    days = list(agg.query(0, 2 ** 40, defined="date"))
+    for period_field in ("week", "month"):
+        expected = {}
+        for rec in days:
+            if rec["plaything_name"] != "-":
+                key = (period_bounds(period_field, rec["start_ts"])[0], rec["tag"], rec["plaything_name"], rec["plaything_part"], rec["specification_id"])
+                expected[key] = expected.get(key, 0) + rec["count"]
+        got = {(rec[period_field], rec["tag"], rec["plaything_name"], rec["plaything_part"], rec["specification_id"]): rec["count"]
+               for rec in agg.query(0, 2 ** 40, defined=period_field)}
+        assert got == expected
+
+
+def test_rollups_are_accumulated_in_memory_across_days():
+    start_ts = recent_hours(n_hours)
+    activity = activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 5000))
+    agg = CountingStore()
+    aggregator.aggregator(activity, agg, {"max_agg_hours": 1})  # the first run also rolls up any existing day records, once
+    agg.queries.clear()
+    aggregator.aggregator(activity, agg, {"max_agg_hours": n_hours - 1})
+    # at most one read of earlier days, for a week or month which started before the first day of the run
+    assert agg.queries["date"] <= 1
+    assert agg.deleted == []  # there were no nil activity records to delete
+
+    # runs which end part way through days and weeks give the same records
+    split = CountingStore()
+    for hours in [31] * (n_hours // 31) + [n_hours % 31]:
+        aggregator.aggregator(activity, split, {"max_agg_hours": hours})
+    assert records(split) == records(agg)
+
+
+def run_hours(agg, accs, start_ts, end_ts, active_from_ts):
+    # complete the hours [start_ts, end_ts) as the aggregator does, with one row of activity in each hour from active_from_ts
+    for hour_ts in range(start_ts, end_ts, 3600):
+        acc = aggregator.HourAccumulator()
+        if hour_ts >= active_from_ts:
+            acc.add({"tag": "t", "plaything_name": "p", "plaything_part": "x", "specification_id": "s", "session_id": str(hour_ts)})
+        recs = acc.records(hour_ts)
+        agg.write_many(recs + aggregator.complete_hour(agg, accs, hour_ts, recs, []))
+
+
+def test_nil_rollup_is_deleted_only_if_it_was_written():
+    monday, wednesday = ts(2026, 3, 2), ts(2026, 3, 4)
+    nil_ids = {aggregator.record_id("week", "2026-W10", aggregator.nil_key), aggregator.record_id("month", "2026-03", aggregator.nil_key)}
+    for new_invocation in (False, True):
+        agg = CountingStore()
+        accs = {}
+        run_hours(agg, accs, monday, wednesday, wednesday)
+        assert {rec["id"] for period_field in ("week", "month") for rec in agg.query(0, 2 ** 40, defined=period_field)} == nil_ids
+        # the first activity of the week and month; with a new invocation, the nil days are read back rather than held in memory
+        run_hours(agg, {} if new_invocation else accs, wednesday, wednesday + 86400, wednesday)
+        assert set(agg.deleted) == nil_ids
+        assert [rec["count"] for rec in agg.query(0, 2 ** 40, defined="week")] == [24]
+
+    # a period whose first day has activity never had a nil activity record
+    agg = CountingStore()
+    run_hours(agg, {}, wednesday, wednesday + 2 * 86400, wednesday)
+    assert agg.deleted == []
@@ -0,0 +1,71 @@
+import time
+from datetime import datetime as dt, timezone
+
+from flask import Flask
+
+import agg_series
+from agg_cube import AggCube
+from agg_series import SeriesCache, series_response
+from test.common import random_rows, recent_hours, activity_store, aggregate
+
+n_hours = 48
+
+
+def day(ts):
+    return dt.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def series_app():
+    start_ts = recent_hours(n_hours)
+    agg = aggregate(activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 1000)), n_hours)
+    series_cache = SeriesCache(agg, AggCube(agg, ttl=0), ttl=0)
+    app = Flask(__name__)
+
+    @app.route("/series")
+    def series():
+        return series_response(series_cache, ["Europe/London"], 10)
+
+    url = f"/series?facet=tag&start_date={day(start_ts)}&end_date={day(start_ts + 3600 * (n_hours - 1))}"
+    return agg, series_cache, app.test_client(), url
+
+
+def test_series_etag_revalidates_without_recomputing():
+    agg, series_cache, client, url = series_app()
+    response = client.get(url)
+    assert response.status_code == 200 and response.json["facet"] == "tag"
+    assert sum(response.json["data"]["count"]) == 1000
+    etag = response.headers["ETag"].strip('"')
+    misses = series_cache._range_query.cache_info().misses
+
+    response = client.get(url, headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304 and response.data == b""
+    assert series_cache._range_query.cache_info().misses == misses
+    assert client.get(url + "&metric=sessions").headers["ETag"].strip('"') != etag
+
+    # new aggregated data (here, a record modified later than any the cube has loaded) changes the version, so the ETag
+    rec = next(iter(agg.query(0, 2 ** 40, defined="date_hr")))
+    agg.write_many([dict(rec, count=rec["count"] + 1, _ts=int(time.time()) + 60)])
+    response = client.get(url, headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 200 and response.headers["ETag"].strip('"') != etag
+    assert sum(response.json["data"]["count"]) == 1001
+
+
+def test_series_rejects_bad_params(monkeypatch):
+    _, _, client, url = series_app()
+    assert client.get(url + "&tz=Mars/Base").status_code == 400
+    assert client.get(url + "&filter_by=colour").status_code == 400
+    assert client.get("/series?start_date=2026-03-05&end_date=2026-03-01").status_code == 400
+    monkeypatch.setattr(agg_series, "pa", None)
+    assert client.get(url + "&format=arrow").status_code == 406
+
+
+def test_range_query_memo_is_keyed_on_the_data_version():
+    _, series_cache, _, _ = series_app()
+    query = (None, "tag", None, None, "2026-03-01", "2026-03-07", "count")
+    version, series = series_cache.range_query(*query, top_n=2)
+    assert version == series_cache.data_version()
+    assert series_cache.range_query(*query, top_n=2, version=version)[1] is series
+    assert series_cache.range_query(*query, top_n=3, version=version)[1] is not series
+    assert series_cache.range_query(*query, top_n=2, version=version + "-new")[1] is not series
+    series_cache.cache_clear()
+    assert series_cache.range_query(*query, top_n=2, version=version)[1] is not series
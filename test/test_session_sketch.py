@@ -0,0 +1,41 @@
+import math
+
+from session_sketch import SessionSketch, STANDARD_ERROR, merge_sketches, distinct_sessions
+
+
+def relative_errors(n, trials=40):
+    return [SessionSketch().update(f"session-{trial}-{i}" for i in range(n)).estimate() / n - 1 for trial in range(trials)]
+
+
+def test_estimate_is_within_the_documented_error():
+    for n in (20, 300, 1000, 10000):
+        errors = relative_errors(n)
+        # a standard error of about 6.5%, so about 95% of estimates within two standard errors
+        assert math.sqrt(sum(e * e for e in errors) / len(errors)) < 1.25 * STANDARD_ERROR, n
+        assert sum(abs(e) <= 2 * STANDARD_ERROR for e in errors) >= 0.9 * len(errors), n
+
+
+def test_merge_is_the_sketch_of_the_union():
+    hours = [[f"session-{i}" for i in range(start, start + 400)] for start in range(0, 2000, 200)]  # overlapping sets of ids
+    merged = merge_sketches([SessionSketch().update(ids).to_string() for ids in hours])
+    union = SessionSketch().update(i for ids in hours for i in ids)
+    assert merged.registers == union.registers
+    assert abs(merged.estimate() / 2200 - 1) < 3 * STANDARD_ERROR
+
+
+def test_serialisation_round_trips():
+    for n in (0, 3, 1000):  # empty, sparse and dense
+        sketch = SessionSketch().update(range(n))
+        s = sketch.to_string()
+        assert s[0] == ("d" if n == 1000 else "s")
+        assert SessionSketch.from_string(s).registers == sketch.registers
+
+
+def test_distinct_sessions_is_bounded_by_the_exact_values():
+    # sketches of the same 50 sessions in each of three records: at least the largest record's sessions, at most their sum
+    same = SessionSketch().update(range(50)).to_string()
+    assert distinct_sessions([50, 50, 50], [same, same, same]) == 50
+    assert distinct_sessions([40, 30], [SessionSketch().update(range(1000)).to_string()] * 2) == 70
+    # records without a sketch fall back to the sum
+    assert distinct_sessions([50, 50], [same, None]) == 100
+    assert distinct_sessions([], []) == 0
@@ -0,0 +1,70 @@
+import pytest
+
+from agg_store import AggStore, SQLiteStore, check_field
+
+
+def store_with(docs):
+    store = SQLiteStore()
+    store.write_many(docs)
+    return store
+
+
+def test_query_range_fields_and_filters():
+    store = store_with([{"id": str(i), "start_ts": 100 * i, "tag": "a" if i % 2 else "b", "count": i} for i in range(10)]
+                       + [{"id": "day", "start_ts": 0, "date": "1970-01-01", "count": 99}])
+    assert sorted(doc["count"] for doc in store.query(200, 500)) == [2, 3, 4]  # end is exclusive
+    assert sorted(doc["count"] for doc in store.query(0, 1000, equals={"tag": "a"})) == [1, 3, 5, 7, 9]
+    assert [doc["count"] for doc in store.query(0, 1000, defined="date")] == [99]
+    # like Cosmos, fields which a record does not have are left out rather than returned as null
+    assert sorted(store.query(0, 1, fields=["id", "tag"]), key=lambda doc: doc["id"]) == [{"id": "0", "tag": "b"}, {"id": "day"}]
+
+
+def test_distinct_and_aggregate_values():
+    store = SQLiteStore()
+    assert store.max_value("start_ts") is None
+    store.write_many([{"id": "1", "start_ts": 5, "tag": "a", "plaything_name": "p"},
+                      {"id": "2", "start_ts": 9, "tag": "b", "plaything_name": "q"},
+                      {"id": "3", "start_ts": 7, "plaything_name": "q"}])
+    assert sorted(store.distinct_values("tag")) == ["a", "b"]
+    assert store.distinct_values("tag", equals={"plaything_name": "q"}) == ["b"]
+    assert (store.min_value("start_ts"), store.max_value("start_ts"), store.max_value("tag")) == (5, 9, "b")
+
+
+def test_writes_upsert_by_id_and_generate_missing_ids():
+    store = SQLiteStore()
+    assert store.write_many([{"id": "x", "start_ts": 1, "count": 1}, {"start_ts": 2, "count": 2}]) == 2
+    store.write_many([{"id": "x", "start_ts": 1, "count": 3}], checkpoint={"id": "mark", "partition_key": "1", "done": True})
+    docs = list(store.query(0, 10))
+    assert sorted(doc["count"] for doc in docs) == [2, 3]
+    assert all(doc["id"] for doc in docs) and all("_ts" in doc for doc in docs)
+    assert store.read_item("mark")["done"]
+    assert store.read_item("missing") is None
+    assert store.delete_item("x") and not store.delete_item("x")
+
+
+def test_change_feed_and_modified_since():
+    store = store_with([{"id": "old", "start_ts": 1, "_ts": 10}])
+    feed = store.read_changes(None)
+    assert list(feed) == []  # a new feed starts from now
+    store.write_many([{"id": "new", "start_ts": 2, "_ts": 20}, {"id": "old", "start_ts": 1, "_ts": 30}])
+    feed = store.read_changes(feed.continuation)
+    assert [doc["id"] for doc in feed] == ["new", "old"]  # an update is a change, like a new document
+    assert list(store.read_changes(feed.continuation)) == []
+    assert sorted(doc["id"] for doc in store.modified_since(20)) == ["new", "old"]
+
+
+def test_field_names_are_checked():
+    store = SQLiteStore()
+    with pytest.raises(ValueError):
+        list(store.query(0, 1, fields=["tag') IS NOT NULL OR ('1"]))
+    with pytest.raises(ValueError):
+        check_field("a.b")
+
+
+def test_back_ends_must_implement_every_operation():
+    class QueryOnly(AggStore):
+        def query(self, start_ts, end_ts, fields=None, equals=None, defined=None):
+            return []
+
+    with pytest.raises(TypeError):
+        QueryOnly("start_ts")
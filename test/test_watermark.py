@@ -0,0 +1,41 @@
+import aggregator
+from agg_store import WATERMARK_ID, SQLiteStore
+from test.common import random_rows, recent_hours, activity_store, aggregate, records
+
+n_hours = 72
+
+
+class ScanCountingStore(SQLiteStore):
+    # counts the MAX() scans which the watermark replaces
+    scans = 0
+
+    def max_value(self, field):
+        self.scans += 1
+        return super().max_value(field)
+
+
+def test_watermark_advances_without_scans():
+    start_ts = recent_hours(n_hours)
+    activity = activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 1000))
+    agg = ScanCountingStore()
+    aggregator.aggregator(activity, agg, {"max_agg_hours": 10})
+    assert agg.read_item(WATERMARK_ID)["watermark_ts"] == start_ts + 9 * 3600
+    scans = agg.scans  # the first run has no watermark, so scans once
+    aggregator.aggregator(activity, agg, {"max_agg_hours": 10})
+    assert agg.read_item(WATERMARK_ID)["watermark_ts"] == start_ts + 19 * 3600
+    assert agg.scans == scans
+
+
+def test_watermark_recovery():
+    start_ts = recent_hours(n_hours)
+    activity = activity_store(random_rows(start_ts, start_ts + 3600 * n_hours, 2000))
+    expected = records(aggregate(activity, n_hours))
+
+    agg = SQLiteStore()
+    aggregator.aggregator(activity, agg, {"max_agg_hours": 30})
+    assert agg.read_item(WATERMARK_ID)["watermark_ts"] == start_ts + 29 * 3600
+    assert agg.delete_item(WATERMARK_ID)
+    # the latest aggregated hour is found by scanning, and aggregation carries on from there
+    aggregator.aggregator(activity, agg, {"max_agg_hours": n_hours - 30})
+    assert agg.read_item(WATERMARK_ID)["watermark_ts"] == start_ts + (n_hours - 1) * 3600
+    assert records(agg) == expected